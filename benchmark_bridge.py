@@ -0,0 +1,503 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the poll -> publish pipeline without a heatpump.
+
+Starts modbus_simulator.py on a pty and a minimal in-process MQTT broker,
+runs a copy of bridge.py against them in a scratch directory and measures:
+  - Modbus transactions per second and errors (from the bridge's /metrics)
+  - wall time of a full read of each poll group (coils, FC04 bank, EM23, FC06 bank)
+  - command write -> confirmed state latency (vv_setpoint round trips)
+  - CPU time per poll cycle and RSS of the bridge process
+  - MQTT messages and bytes per minute published by the bridge
+The results are written as JSON so runs can be compared over time.
+
+--mode features-off switches the optional optimizations off for comparison:
+one read per FC04 register (the simulator rejects block reads), one FC06
+echo per setting, no adaptive polling, no command coalescing and a fixed
+serial timeout. The per-register poll intervals and the skipping of omitted
+registers stay, so it is not the original bridge; check out an older
+revision for that.
+
+--mode legacy reproduces the original bridge's access pattern on top of that:
+its 13s/17s/60s timers (coils 13s, FC04 and EM23 power 17s, EM23 energy
+and all FC06 reads 60s) and a read of every FC04 register 0x01-0x0E,
+omitted ones included. Compare it with the current mode to measure the
+scheduler and the per-class intervals as well.
+
+Usage:
+  python benchmark_bridge.py --duration 120
+  python benchmark_bridge.py --mode features-off --output features-off.json
+  python benchmark_bridge.py --mode legacy --output legacy.json
+"""
+
+import argparse
+import json
+import os
+import shutil
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BRIDGE_FILES = ("bridge.py", "registers.py", "diagnostics.py", "metrics.py", "transport.py",
+                "read_static_values_modbustk.py")
+
+MODES = {
+    "current": {"simulator": [], "env": {}},
+    "features-off": {
+        "simulator": ["--no-block-fc04"],
+        "env": {"SETTINGS_BLOCK_PROBE": "0", "ADAPTIVE_POLLING": "0", "COMMAND_QUIET_WINDOW": "0",
+                "ADAPTIVE_TIMEOUT": "0"},
+    },
+}
+MODES["legacy"] = {
+    "simulator": MODES["features-off"]["simulator"],
+    "env": {**MODES["features-off"]["env"], "POLL_OMITTED_INPUTS": "1",
+            "POLL_INTERVALS": "coils:13,fc04:17,em23_power:17,em23_energy:60,"
+                              "fc06_live:60,fc06_settings:60,fc06_counters:60"},
+}
+
+# Poll class -> benchmark group
+POLL_GROUPS = {"coils": "coils", "fc04": "fc04", "em23": "em23",
+               "fc06_live": "fc06", "fc06_settings": "fc06", "fc06_counters": "fc06"}
+
+COMMAND_TOPIC = "dvi/command/vvsetpoint"
+COMMAND_KEY = "vv_setpoint"
+COMMAND_VALUES = (50, 51)
+
+
+# --- MQTT broker stand-in (MQTT 3.1.1, QoS 0/1, retained, no auth) ---------
+
+class BrokerStandIn:
+    def __init__(self) -> None:
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(8)
+        self.port = self.sock.getsockname()[1]
+        self.lock = threading.Lock()
+        self.clients = {}  # conn -> set of topic filters
+        self.retained = {}
+        self.received = []  # (time, topic, payload bytes) published by clients
+        self.listeners = []  # callables(topic, payload)
+
+    def start(self) -> None:
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self) -> None:
+        while True:
+            conn, _ = self.sock.accept()
+            threading.Thread(target=self._client, args=(conn,), daemon=True).start()
+
+    @staticmethod
+    def _read_exact(conn, n: int) -> bytes:
+        buf = b""
+        while len(buf) < n:
+            chunk = conn.recv(n - len(buf))
+            if not chunk:
+                raise ConnectionError
+            buf += chunk
+        return buf
+
+    def _read_packet(self, conn):
+        header = self._read_exact(conn, 1)[0]
+        multiplier, length = 1, 0
+        while True:
+            byte = self._read_exact(conn, 1)[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header, self._read_exact(conn, length) if length else b""
+
+    @staticmethod
+    def _send(conn, header: int, body: bytes) -> None:
+        length, encoded = len(body), b""
+        while True:
+            byte, length = length % 128, length // 128
+            encoded += bytes([byte | (0x80 if length else 0)])
+            if not length:
+                break
+        try:
+            conn.sendall(bytes([header]) + encoded + body)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _matches(topic_filter: str, topic: str) -> bool:
+        fparts, tparts = topic_filter.split("/"), topic.split("/")
+        for i, part in enumerate(fparts):
+            if part == "#":
+                return True
+            if i >= len(tparts) or (part != "+" and part != tparts[i]):
+                return False
+        return len(fparts) == len(tparts)
+
+    def publish(self, topic: str, payload: bytes, retain: bool = False) -> None:
+        """Deliver a message to the subscribed clients (used for commands)."""
+        body = struct.pack(">H", len(topic)) + topic.encode() + payload
+        with self.lock:
+            if retain:
+                self.retained[topic] = payload
+            targets = [(conn, set(filters)) for conn, filters in self.clients.items()]
+        for conn, filters in targets:
+            if any(self._matches(f, topic) for f in filters):
+                self._send(conn, 0x30, body)
+
+    def _client(self, conn) -> None:
+        with self.lock:
+            self.clients[conn] = set()
+        try:
+            while True:
+                header, body = self._read_packet(conn)
+                packet_type = header >> 4
+                if packet_type == 1:  # CONNECT
+                    self._send(conn, 0x20, b"\x00\x00")
+                elif packet_type == 3:  # PUBLISH
+                    qos = (header >> 1) & 3
+                    tlen = struct.unpack(">H", body[:2])[0]
+                    topic = body[2:2 + tlen].decode()
+                    pos = 2 + tlen
+                    if qos:
+                        self._send(conn, 0x40, body[pos:pos + 2])
+                        pos += 2
+                    payload = body[pos:]
+                    with self.lock:
+                        self.received.append((time.monotonic(), topic, len(payload)))
+                    for listener in self.listeners:
+                        listener(topic, payload)
+                    self.publish(topic, payload, retain=bool(header & 1))
+                elif packet_type == 8:  # SUBSCRIBE
+                    pid, pos, granted, filters = body[:2], 2, b"", []
+                    while pos < len(body):
+                        flen = struct.unpack(">H", body[pos:pos + 2])[0]
+                        filters.append(body[pos + 2:pos + 2 + flen].decode())
+                        pos += 2 + flen + 1
+                        granted += b"\x00"
+                    with self.lock:
+                        self.clients[conn].update(filters)
+                        retained = list(self.retained.items())
+                    self._send(conn, 0x90, pid + granted)
+                    for topic, payload in retained:
+                        if any(self._matches(f, topic) for f in filters):
+                            self._send(conn, 0x31, struct.pack(">H", len(topic)) + topic.encode() + payload)
+                elif packet_type == 12:  # PINGREQ
+                    self._send(conn, 0xD0, b"")
+                elif packet_type == 14:  # DISCONNECT
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            with self.lock:
+                self.clients.pop(conn, None)
+            conn.close()
+
+    def traffic_since(self, since: float) -> tuple:
+        """(messages, payload bytes) published by clients since a monotonic time."""
+        with self.lock:
+            recent = [size for at, _, size in self.received if at >= since]
+        return len(recent), sum(recent)
+
+
+# --- Bridge process probes --------------------------------------------------
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def scrape_metrics(port: int) -> list:
+    """[(name, labels, value)] from the bridge's /metrics, [] if unavailable."""
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as response:
+            text = response.read().decode()
+    except OSError:
+        return []
+    samples = []
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        series, value = line.rsplit(" ", 1)
+        labels = {}
+        if "{" in series:
+            series, label_str = series[:-1].split("{", 1)
+            for part in label_str.split('",'):
+                key, val = part.split('="', 1)
+                labels[key] = val.rstrip('"')
+        samples.append((series, labels, float(value)))
+    return samples
+
+
+def metric(samples: list, name: str, **labels) -> float:
+    return sum(v for n, l, v in samples if n == name and all(l.get(k) == val for k, val in labels.items()))
+
+
+def process_cpu_seconds(pid: int):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def process_rss_mb(pid: int):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def summarize(values: list) -> dict:
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+    return {
+        "count": len(ordered),
+        "avg_ms": round(1000 * sum(ordered) / len(ordered), 1),
+        "p50_ms": round(1000 * ordered[len(ordered) // 2], 1),
+        "max_ms": round(1000 * ordered[-1], 1),
+    }
+
+
+# --- Benchmark run ----------------------------------------------------------
+
+class CommandProbe:
+    """
+    Sends vv_setpoint commands and times them until dvi/measurement shows the
+    value. Also counts measurements that lost the coils after they had been
+    read once: a failed read must keep the cached values, not blank them
+    (check with --drop-rate).
+    """
+
+    def __init__(self, broker: BrokerStandIn) -> None:
+        self.broker = broker
+        self.lock = threading.Lock()
+        self.state = None
+        self.first_measurement = threading.Event()
+        self.confirmed = threading.Event()
+        self.expected = None
+        self.measurements = 0
+        self.without_coils = 0
+        self.had_coils = False
+        broker.listeners.append(self._on_publish)
+
+    def _on_publish(self, topic: str, payload: bytes) -> None:
+        if topic != "dvi/measurement":
+            return
+        try:
+            measurement = json.loads(payload)
+        except ValueError:
+            return
+        state = measurement.get("write_registers", {}).get(COMMAND_KEY)
+        self.first_measurement.set()
+        with self.lock:
+            self.measurements += 1
+            if measurement.get("coils"):
+                self.had_coils = True
+            elif self.had_coils:
+                self.without_coils += 1
+            self.state = state
+            if self.expected is not None and state == self.expected:
+                self.confirmed.set()
+
+    def round_trip(self, value: int, timeout: float):
+        with self.lock:
+            self.expected = value
+            self.confirmed.clear()
+            if self.state == value:
+                return None  # nothing to change
+        started = time.monotonic()
+        self.broker.publish(COMMAND_TOPIC, str(value).encode())
+        if not self.confirmed.wait(timeout):
+            return False
+        return time.monotonic() - started
+
+
+def run(args) -> dict:
+    mode = MODES[args.mode]
+    workdir = tempfile.mkdtemp(prefix="dvi-bench-")
+    link = os.path.join(workdir, "dvi-sim")
+    metrics_port = free_port()
+
+    broker = BrokerStandIn()
+    broker.start()
+    probe = CommandProbe(broker)
+
+    sim_cmd = [sys.executable, os.path.join(BASE_DIR, "modbus_simulator.py"), "--link", link,
+               "--latency", str(args.latency), "--baud", str(args.baud),
+               "--drop-rate", str(args.drop_rate), "--crc-error-rate", str(args.crc_error_rate),
+               "--seed", "1"] + mode["simulator"]
+    simulator = subprocess.Popen(sim_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    for name in BRIDGE_FILES:
+        shutil.copy(os.path.join(BASE_DIR, name), workdir)
+    env_lines = {
+        "MQTT_HOST": "127.0.0.1", "MQTT_PORT": str(broker.port), "DVI_SERIAL_PORT": link,
+        "METRICS_PORT": str(metrics_port), "HEATPUMP_MODEL": "LV",
+    }
+    env_lines.update(mode["env"])
+    with open(os.path.join(workdir, ".env"), "w", encoding="utf-8") as f:
+        f.writelines(f"{key}={value}\n" for key, value in env_lines.items())
+
+    deadline = time.monotonic() + 5
+    while not os.path.exists(link) and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+    log = open(os.path.join(workdir, "bridge.log"), "w", encoding="utf-8")
+    bridge = subprocess.Popen([sys.executable, "-u", "bridge.py"], cwd=workdir, stdout=log,
+                              stderr=subprocess.STDOUT, env={**os.environ, "PYTHONWARNINGS": "ignore"})
+    print(f"ℹ️ Bridge started in {workdir} (mode {args.mode})")
+    try:
+        if not probe.first_measurement.wait(args.startup_timeout):
+            raise RuntimeError("bridge published no dvi/measurement, see bridge.log")
+        print(f"ℹ️ First measurement received, warming up {args.warmup:.0f}s")
+        time.sleep(args.warmup)
+
+        start = time.monotonic()
+        metrics_start = scrape_metrics(metrics_port)
+        cpu_start = process_cpu_seconds(bridge.pid)
+
+        latencies, timeouts, cut_off, value_index = [], 0, 0, 0
+        next_command = start + args.command_interval
+        while time.monotonic() - start < args.duration:
+            if bridge.poll() is not None:
+                raise RuntimeError(f"bridge exited with code {bridge.returncode}, see bridge.log")
+            if args.command_interval and time.monotonic() >= next_command:
+                value_index += 1
+                # Never wait past the measurement window; a command still unconfirmed
+                # when it closes is neither a round trip nor a timeout
+                wait = min(args.command_timeout, args.duration - (time.monotonic() - start))
+                result = probe.round_trip(COMMAND_VALUES[value_index % 2], max(wait, 0.0))
+                if result is False and wait < args.command_timeout:
+                    cut_off += 1
+                elif result is False:
+                    timeouts += 1
+                elif result is not None:
+                    latencies.append(result)
+                next_command = time.monotonic() + args.command_interval
+            time.sleep(0.2)
+
+        elapsed = time.monotonic() - start
+        metrics_end = scrape_metrics(metrics_port)
+        cpu_end = process_cpu_seconds(bridge.pid)
+        messages, payload_bytes = broker.traffic_since(start)
+        rss = process_rss_mb(bridge.pid)
+    finally:
+        bridge.terminate()
+        try:
+            bridge.wait(5)
+        except subprocess.TimeoutExpired:
+            bridge.kill()
+        log.close()
+        simulator.send_signal(signal.SIGINT)
+        try:
+            simulator.wait(5)
+        except subprocess.TimeoutExpired:
+            simulator.kill()
+
+    def delta(name, **labels):
+        return metric(metrics_end, name, **labels) - metric(metrics_start, name, **labels)
+
+    cycles = delta("dvi_poll_cycles_total")
+    groups = {}
+    for name, labels, value in metrics_end:
+        if name == "dvi_poll_unit_seconds":
+            group = POLL_GROUPS.get(labels["poll"], labels["poll"])
+            groups[group] = round(groups.get(group, 0.0) + value, 4)
+    latency_by_function = {}
+    for name, labels, _ in metrics_end:
+        if name == "dvi_modbus_transaction_seconds_count":
+            fc = labels["function"]
+            count = delta("dvi_modbus_transaction_seconds_count", function=fc)
+            total = delta("dvi_modbus_transaction_seconds_sum", function=fc)
+            latency_by_function[fc] = {"count": int(count),
+                                       "avg_ms": round(1000 * total / count, 1) if count else None}
+
+    results = {
+        "mode": args.mode,
+        "git_revision": _git_revision(),
+        "timestamp": int(time.time()),
+        "duration_s": round(elapsed, 1),
+        "simulator": {"latency_ms": args.latency, "baud": args.baud,
+                      "drop_rate": args.drop_rate, "crc_error_rate": args.crc_error_rate},
+        "modbus": {
+            "transactions_per_second": round(delta("dvi_modbus_transactions_total") / elapsed, 2),
+            "errors": int(delta("dvi_modbus_errors_total")),
+            "bytes_per_second": round(delta("dvi_modbus_bytes_total") / elapsed, 1),
+            "latency_by_function": latency_by_function,
+        },
+        "poll_group_seconds": groups,
+        "poll_cycles": int(cycles),
+        "cpu_ms_per_cycle": round(1000 * (cpu_end - cpu_start) / cycles, 2)
+        if cycles and cpu_start is not None and cpu_end is not None else None,
+        "cpu_percent": round(100 * (cpu_end - cpu_start) / elapsed, 2)
+        if cpu_start is not None and cpu_end is not None else None,
+        "rss_mb": rss,
+        "mqtt": {
+            "messages_per_minute": round(60 * messages / elapsed, 1),
+            "bytes_per_minute": round(60 * payload_bytes / elapsed, 1),
+        },
+        "command_latency": {**summarize(latencies), "timeouts": timeouts, "unconfirmed_at_end": cut_off},
+        "measurements": {"published": probe.measurements, "without_coils": probe.without_coils},
+    }
+    if probe.without_coils:
+        print(f"⚠️ {probe.without_coils} of {probe.measurements} measurements were published after losing the coils")
+    if args.keep:
+        print(f"ℹ️ Kept {workdir}")
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR,
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark bridge.py against modbus_simulator.py")
+    parser.add_argument("--mode", choices=sorted(MODES), default="current")
+    parser.add_argument("--duration", type=float, default=120.0, help="measurement window in seconds (default 120)")
+    parser.add_argument("--warmup", type=float, default=10.0, help="seconds after the first publish before measuring")
+    parser.add_argument("--startup-timeout", type=float, default=90.0)
+    parser.add_argument("--command-interval", type=float, default=15.0,
+                        help="send a vv_setpoint command every N seconds, 0 disables (default 15)")
+    parser.add_argument("--command-timeout", type=float, default=120.0)
+    parser.add_argument("--latency", type=float, default=20.0, help="simulator turnaround in ms")
+    parser.add_argument("--baud", type=int, default=9600)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--crc-error-rate", type=float, default=0.0)
+    parser.add_argument("--output", help="JSON file to write (default benchmark-<mode>-<time>.json)")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory with bridge.log")
+    args = parser.parse_args(argv)
+
+    try:
+        results = run(args)
+    except RuntimeError as e:
+        print(f"❌ Benchmark failed: {e}")
+        sys.exit(1)
+
+    output = args.output or f"benchmark-{args.mode}-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+    print(f"💾 Wrote {output}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,101 +1,472 @@
 from dotenv import load_dotenv
-import sys
 import os
-import minimalmodbus
 import paho.mqtt.client as mqtt
 import struct
 import json
+import hashlib
 import time
 import threading
 import warnings
-import glob
-import subprocess
+import heapq
+import itertools
+import functools
+import queue
+import signal
 import socket  # <-- nødvendig til _get_default_gateway_linux
 from typing import Optional
 
-# Find STM32 Virtual COM Port automatically
-devices = glob.glob("/dev/serial/by-id/*STM32*")
-
-if not devices:
-    print("❌ STM32 Virtual COM Port not found! Check USB cable and that the heatpump interface is connected.")
-    raise RuntimeError("STM32 Virtual COM Port not found!")
-else:
-    serial_port = devices[0]
-    print(f"✅ Connected to STM32 Virtual COM Port: {serial_port}")
+from diagnostics import LatencyHistogram, ModbusStats, RegisterHealth
+from metrics import format_metrics, serve_metrics
+from transport import AdaptiveTimeout, SlaveReportedException, Transport, spec_from_env
+from read_static_values_modbustk import (
+    FABNR_ADDR,
+    INDA_ADDR,
+    SEDA_ADDR,
+    SWBOT_ADDR,
+    SWTOP_ADDR,
+    convert_date_to_dict,
+    convert_fabnr_to_pumpid,
+    convert_sw_to_float,
+    persist_static_values,
+)
+from registers import (
+    ACTIVE_COILS,
+    ADAPTIVE_INTERVALS,
+    COIL_BLOCK,
+    COMMAND_REGISTERS,
+    CURVE_REGISTERS,
+    FC_COILS,
+    FC_ECHO,
+    FC_INPUT,
+    PRIORITY_COMMAND,
+    PRIORITY_NORMAL,
+    PRIORITY_SLOW,
+    REGISTERS,
+    REGISTERS_BY_KEY,
+    block_ranges,
+)
 
 load_dotenv()  # this will read .env in the current directory
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-STATIC_VALUES_SCRIPT = os.path.join(SCRIPT_DIR, "read_static_values_modbustk.py")
+# Static identity, cached in .env and refreshed from the DVI by refresh_static_values()
+PUMP_ID: Optional[str] = None
+SWBOT: Optional[str] = None
+SWTOP: Optional[str] = None
+INSTALL_DD: Optional[str] = None
+INSTALL_MM: Optional[str] = None
+INSTALL_YY: Optional[str] = None
+SERVICE_DD: Optional[str] = None
+SERVICE_MM: Optional[str] = None
+SERVICE_YY: Optional[str] = None
+
+def _load_static_values() -> None:
+    global PUMP_ID, SWBOT, SWTOP, INSTALL_DD, INSTALL_MM, INSTALL_YY, SERVICE_DD, SERVICE_MM, SERVICE_YY
+    PUMP_ID = os.getenv("FABNR") or None
+    SWBOT = os.getenv("SWBOT") or None
+    SWTOP = os.getenv("SWTOP") or None
+    INSTALL_DD = os.getenv("INSTALL_DD") or None
+    INSTALL_MM = os.getenv("INSTALL_MM") or None
+    INSTALL_YY = os.getenv("INSTALL_YY") or None
+    SERVICE_DD = os.getenv("SERVICE_DD") or None
+    SERVICE_MM = os.getenv("SERVICE_MM") or None
+    SERVICE_YY = os.getenv("SERVICE_YY") or None
+
+def _log_static_values() -> None:
+    if PUMP_ID:
+        print(f"🆔 Fabrication ID set to: {PUMP_ID}")
+    else:
+        print("⚠️ No fabrication ID (FABNR) found – will not be able to upload data to DVI backend.")
 
-def _refresh_static_values() -> None:
-    if not os.path.isfile(STATIC_VALUES_SCRIPT):
-        print("⚠️ read_static_values_modbustk.py not found; skipping static refresh.")
-        return
-    print("ℹ️ Refreshing static values via read_static_values_modbustk.py ...")
+    if SWBOT or SWTOP:
+        print(f"ℹ️ SW versions: SWBOT={SWBOT or 'unknown'}, SWTOP={SWTOP or 'unknown'}")
+    else:
+        print("ℹ️ No SWBOT/SWTOP set in .env")
+
+    if INSTALL_DD and INSTALL_MM and INSTALL_YY:
+        print(f"ℹ️ Install date: {INSTALL_DD}-{INSTALL_MM}-{INSTALL_YY}")
+    else:
+        print("ℹ️ No install date (INDA) set in .env")
+
+    if SERVICE_DD and SERVICE_MM and SERVICE_YY:
+        print(f"ℹ️ Service date: {SERVICE_DD}-{SERVICE_MM}-{SERVICE_YY}")
+    else:
+        print("ℹ️ No service date (SEDA) set in .env")
+
+_load_static_values()
+
+# Modbus setup: one transport owns the link (DVI_TRANSPORT / DVI_SERIAL_PORT, default
+# the auto-detected STM32 Virtual COM Port), see transport.py. If the port is missing
+# or disappears later, the transport keeps reopening it instead of the service crashing.
+transport = Transport(spec_from_env())
+try:
+    transport.connect()
+    print(f"✅ Connected to heatpump interface: {transport}")
+except Exception as e:
+    print(f"❌ Could not open the heatpump interface: {e}")
+    transport.mark_lost("not available at startup")
+
+# Adaptive timeout: the transport already keeps the RTU minimum silent period
+# (3.5 characters) between frames and learns how long to wait for read replies,
+# see transport.AdaptiveTimeout. Writes always get the full timeout.
+ADAPTIVE_TIMEOUT = os.getenv("ADAPTIVE_TIMEOUT", "1") != "0"
+serial_timeout = transport.adaptive = AdaptiveTimeout(ADAPTIVE_TIMEOUT)
+
+# Transaction statistics, published on dvi/diagnostics/modbus
+modbus_stats = ModbusStats()
+transport.on_bytes = modbus_stats.count_bytes
+
+# --- Modbus bus arbiter -----------------------------------------------------
+
+PRIORITY_NAMES = {0: "command", 1: "fast", 2: "normal", 3: "slow"}
+
+class BusArbiter:
+    """
+    Owns the serial port: every Modbus transaction runs on one worker thread,
+    taken from a priority queue (MQTT commands first, then fast sensors, then
+    slow settings). call() blocks the caller until its transaction is done,
+    submit() queues a job and returns at once, so the MQTT network thread never
+    waits on serial I/O.
+    """
+
+    def __init__(self) -> None:
+        self._queue: queue.PriorityQueue = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._wait: dict = {}  # priority -> [count, total wait, max wait]
+        self.max_depth = 0
+        self._thread = threading.Thread(target=self._run, name="modbus-bus", daemon=True)
+        self._thread.start()
+
+    @property
+    def priority(self) -> int:
+        """Priority used by call() from the current thread."""
+        return getattr(self._local, "priority", PRIORITY_NORMAL)
+
+    def run_at(self, priority: int, func, *args):
+        """Run func with every bus call it makes queued at priority."""
+        previous = self.priority
+        self._local.priority = priority
+        try:
+            return func(*args)
+        finally:
+            self._local.priority = previous
+
+    def submit(self, priority: int, func, *args, waited_on: bool = False) -> dict:
+        request = {"func": func, "args": args, "queued": time.monotonic(), "waited_on": waited_on,
+                   "done": threading.Event(), "result": None, "error": None}
+        self._queue.put((priority, next(self._seq), request))
+        depth = self._queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+        return request
+
+    def call(self, func, *args):
+        if threading.current_thread() is self._thread:
+            return func(*args)  # already on the bus (e.g. inside a command job)
+        request = self.submit(self.priority, func, *args, waited_on=True)
+        request["done"].wait()
+        if request["error"] is not None:
+            raise request["error"]
+        return request["result"]
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def _run(self) -> None:
+        while True:
+            priority, _, request = self._queue.get()
+            waited = time.monotonic() - request["queued"]
+            with self._stats_lock:
+                stats = self._wait.setdefault(priority, [0, 0.0, 0.0])
+                stats[0] += 1
+                stats[1] += waited
+                stats[2] = max(stats[2], waited)
+            self._local.priority = priority
+            try:
+                request["result"] = request["func"](*request["args"])
+            except Exception as e:
+                request["error"] = e
+                if not request["waited_on"]:
+                    print(f"❌ Modbus job {getattr(request['func'], '__name__', request['func'])} failed: {e}")
+            finally:
+                request["done"].set()
+
+    def snapshot(self, reset: bool = False) -> dict:
+        """Queue depth and wait time (ms) per priority since the last reset."""
+        with self._stats_lock:
+            waits = {
+                PRIORITY_NAMES.get(p, str(p)): {
+                    "requests": n,
+                    "avg_wait_ms": round(1000 * total / n, 1) if n else 0.0,
+                    "max_wait_ms": round(1000 * peak, 1),
+                }
+                for p, (n, total, peak) in sorted(self._wait.items())
+            }
+            snapshot = {"depth": self.depth(), "max_depth": self.max_depth, "wait": waits}
+            if reset:
+                self._wait.clear()
+                self.max_depth = self.depth()
+        return snapshot
+
+    def report(self) -> dict:
+        snap = self.snapshot(reset=True)
+        waits = ", ".join(
+            f"{name} {w['requests']}x avg {w['avg_wait_ms']}ms max {w['max_wait_ms']}ms"
+            for name, w in snap["wait"].items()
+        )
+        print(f"🚌 Modbus bus: queue depth {snap['depth']} (max {snap['max_depth']}); waits: {waits or 'none'}")
+        return snap
+
+
+bus = BusArbiter()
+
+# Registers that keep failing are quarantined with exponential backoff
+register_health = RegisterHealth()
+
+def _transaction(functioncode: int, register: int, func, *args, health: bool = True, count: int = 1):
     try:
-        result = subprocess.run(
-            [sys.executable, STATIC_VALUES_SCRIPT],
-            cwd=os.path.dirname(STATIC_VALUES_SCRIPT),
-            timeout=60,
-            capture_output=True,
-            text=True,
+        result = modbus_stats.timed(functioncode, register, func, *args)
+    except Exception:
+        if not health:
+            raise
+        backoff = register_health.failed(functioncode, register, count)
+        if backoff:
+            print(f"🚧 {RegisterHealth.key(functioncode, register, count)} keeps failing, skipping it for {backoff:.0f}s")
+        raise
+    if health and register_health.succeeded(functioncode, register, count):
+        print(f"✅ {RegisterHealth.key(functioncode, register, count)} answers again, quarantine lifted")
+    return result
+
+def modbus_call(functioncode: int, register: int, func, *args, count: int = 1):
+    """
+    One serial transaction on the bus, timed and counted in modbus_stats.
+    count > 1 marks a block read, whose health is tracked apart from its first register.
+    """
+    return bus.call(functools.partial(_transaction, count=count), functioncode, register, func, *args)
+
+def probe_call(functioncode: int, register: int, func, *args):
+    """modbus_call for capability probes: a failure says nothing about the register's health."""
+    return bus.call(functools.partial(_transaction, health=False), functioncode, register, func, *args)
+
+# --- Static identity (FABNR, SW versions, install/service date) -------------
+# Read in-process over the open port instead of spawning read_static_values_modbustk.py,
+# and only when the cached values in .env are missing or older than STATIC_REFRESH_HOURS.
+# .env is only rewritten when a value changed; the time of the last read is kept
+# in the state snapshot.
+
+STATIC_REFRESH_INTERVAL = float(os.getenv("STATIC_REFRESH_HOURS", "24")) * 3600
+static_refreshed_at = 0.0  # wall time of the last successful read
+
+# .env name -> (register, data bytes in the FC06 reply; the DVI answers these with more than the usual 2)
+STATIC_REGISTERS = {
+    "FABNR": (FABNR_ADDR, 6),
+    "SWBOT": (SWBOT_ADDR, 5),
+    "SWTOP": (SWTOP_ADDR, 5),
+    "INDA": (INDA_ADDR, 5),
+    "SEDA": (SEDA_ADDR, 5),
+}
+
+def read_static_raw(register: int, data_bytes: int) -> tuple:
+    """FC06 write of 0 to a static register; returns the data bytes after the function code."""
+    return tuple(modbus_call(FC_ECHO, register, transport.read_static, register, data_bytes))
+
+def static_values_stale() -> bool:
+    if not PUMP_ID or not (SWBOT or SWTOP):
+        return True
+    return time.time() - static_refreshed_at >= STATIC_REFRESH_INTERVAL
+
+def refresh_static_values() -> bool:
+    """Re-read the static registers and cache them in .env. True if the SW version changed."""
+    global static_refreshed_at
+    raw = {}
+    for name, (register, data_bytes) in STATIC_REGISTERS.items():
+        try:
+            raw[name] = read_static_raw(register, data_bytes)
+        except Exception as e:
+            print(f"⚠️ Failed to read {name} (register {register}): {e}")
+    try:
+        pumpid = convert_fabnr_to_pumpid(raw["FABNR"])
+    except (KeyError, ValueError) as e:
+        print(f"⚠️ No usable FABNR from the DVI ({e}); keeping the values from .env")
+        return False
+
+    converted = {}
+    for name, convert in (("SWBOT", lambda seq: convert_sw_to_float(seq)[1]),
+                          ("SWTOP", lambda seq: convert_sw_to_float(seq)[1]),
+                          ("INDA", convert_date_to_dict), ("SEDA", convert_date_to_dict)):
+        try:
+            converted[name] = convert(raw[name]) if name in raw else None
+        except ValueError as e:
+            print(f"⚠️ Failed to convert {name}: {e}")
+            converted[name] = None
+
+    previous_sw = (SWBOT, SWTOP)
+    persist_static_values(pumpid, converted["SWBOT"], converted["SWTOP"], converted["INDA"], converted["SEDA"])
+    static_refreshed_at = time.time()
+    load_dotenv(override=True)
+    _load_static_values()
+    print(f"🆔 Static values read from the DVI: FABNR {pumpid}, "
+          f"SWBOT {converted['SWBOT'] or '?'}, SWTOP {converted['SWTOP'] or '?'}")
+    return previous_sw != (SWBOT, SWTOP) and any(previous_sw)
+
+def refresh_static_values_task() -> None:
+    """Scheduled refresh; a new firmware version changes the HA device, so discovery is republished."""
+    if bus.run_at(PRIORITY_SLOW, refresh_static_values):
+        print(f"🆕 SW version changed (SWBOT={SWBOT}, SWTOP={SWTOP}), republishing discovery")
+        publish_all_discovery()
+
+# --- Poll scheduler ---------------------------------------------------------
+
+class PollScheduler:
+    """
+    Heap of next-due poll tasks. The main thread sleeps until the earliest
+    task is due, or until wake()/trigger() is called from another thread
+    (e.g. the MQTT thread after a command), instead of ticking every second.
+    """
+
+    def __init__(self, report_interval: float = 300.0) -> None:
+        self._heap: list = []  # (due, seq, name); stale entries are skipped
+        self._tasks: dict = {}
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self.report_interval = report_interval
+        self._report_started = time.monotonic()
+        self._report_cpu = time.process_time()
+        self._wakeups = 0
+        self.last_cycle_cpu = 0.0
+        self.last_cycle_wall = 0.0
+        self.cycles = 0
+
+    def add(self, name: str, interval: float, func, delay: float = 0.0,
+            priority: int = 0, phase: float = 0.0) -> None:
+        """
+        Run func every interval seconds, first after delay. Tasks due at the
+        same time run in priority order (lower first); phase shifts every run
+        after the first one.
+        """
+        due = time.monotonic() + delay
+        with self._lock:
+            self._tasks[name] = {"interval": interval, "func": func, "due": due,
+                                 "priority": priority, "phase": phase, "cpu": 0.0, "wall": 0.0}
+            heapq.heappush(self._heap, (due, next(self._seq), name))
+        self._wake.set()
+
+    def trigger(self, name: str) -> None:
+        """Make a task due now and wake the loop."""
+        with self._lock:
+            task = self._tasks.get(name)
+            if task is None:
+                return
+            task["due"] = time.monotonic()
+            heapq.heappush(self._heap, (task["due"], next(self._seq), name))
+        self._wake.set()
+
+    def remove(self, name: str) -> None:
+        """Drop a task; its heap entries are skipped from now on."""
+        with self._lock:
+            self._tasks.pop(name, None)
+
+    def set_interval(self, name: str, interval: float) -> None:
+        """Change a task's interval, counted from its last run."""
+        with self._lock:
+            task = self._tasks.get(name)
+            if task is None or task["interval"] == interval:
+                return
+            due = max(task["due"] - task["interval"] + interval, time.monotonic())
+            task["interval"] = interval
+            task["due"] = due
+            heapq.heappush(self._heap, (due, next(self._seq), name))
+        self._wake.set()
+
+    def last_duration(self, name: str) -> Optional[float]:
+        """Wall time of the task's last run."""
+        task = self._tasks.get(name)
+        return task["wall"] if task else None
+
+    def interval(self, name: str) -> Optional[float]:
+        task = self._tasks.get(name)
+        return task["interval"] if task else None
+
+    def wake(self) -> None:
+        self._wake.set()
+
+    def _next_due(self) -> Optional[float]:
+        with self._lock:
+            while self._heap:
+                due, _, name = self._heap[0]
+                task = self._tasks.get(name)
+                if task is not None and task["due"] == due:
+                    return due
+                heapq.heappop(self._heap)  # superseded by trigger() or removed
+        return None
+
+    def _pop_due(self, now: float) -> list:
+        due_tasks = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                due, seq, name = heapq.heappop(self._heap)
+                task = self._tasks.get(name)
+                if task is None or task["due"] != due:
+                    continue
+                next_due = due + task["interval"] + task["phase"]
+                task["phase"] = 0.0
+                if next_due <= now:
+                    next_due = now + task["interval"]  # fell behind, don't burst
+                task["due"] = next_due
+                heapq.heappush(self._heap, (next_due, next(self._seq), name))
+                due_tasks.append((task["priority"], seq, name, task))
+        due_tasks.sort(key=lambda item: item[:2])
+        return [(name, task) for _, _, name, task in due_tasks]
+
+    def _report(self) -> None:
+        now = time.monotonic()
+        wall = now - self._report_started
+        cpu = time.process_time() - self._report_cpu
+        busiest = sorted(self._tasks.items(), key=lambda item: item[1]["cpu"], reverse=True)[:5]
+        per_task = ", ".join(f"{n}={t['cpu'] * 1000:.0f}ms" for n, t in busiest)
+        print(
+            f"⏱️ Scheduler: {self._wakeups} wakeups in {wall:.0f}s, "
+            f"process CPU {cpu:.2f}s ({100.0 * cpu / max(wall, 1e-9):.2f}%), "
+            f"last cycle {self.last_cycle_cpu * 1000:.1f}ms CPU / {self.last_cycle_wall * 1000:.0f}ms wall; "
+            f"busiest tasks: {per_task}"
         )
-        print(result.stdout, end="")
-        if result.returncode != 0:
-            print(f"⚠️ read_static_values_modbustk.py exited with code {result.returncode}")
-            if result.stderr:
-                print(result.stderr, end="")
-            return
-        load_dotenv(override=True)
-    except Exception as e:
-        print(f"⚠️ Failed to run read_static_values_modbustk.py: {e}")
-
-def _ensure_pump_id() -> Optional[str]:
-    _refresh_static_values()
-    return os.getenv("FABNR") or None
-
-PUMP_ID: Optional[str] = _ensure_pump_id()
-SWBOT: Optional[str] = os.getenv("SWBOT") or None
-SWTOP: Optional[str] = os.getenv("SWTOP") or None
-INSTALL_DD: Optional[str] = os.getenv("INSTALL_DD") or None
-INSTALL_MM: Optional[str] = os.getenv("INSTALL_MM") or None
-INSTALL_YY: Optional[str] = os.getenv("INSTALL_YY") or None
-SERVICE_DD: Optional[str] = os.getenv("SERVICE_DD") or None
-SERVICE_MM: Optional[str] = os.getenv("SERVICE_MM") or None
-SERVICE_YY: Optional[str] = os.getenv("SERVICE_YY") or None
-
-if PUMP_ID:
-    print(f"🆔 Fabrication ID set to: {PUMP_ID}")
-else:
-    print("⚠️ No fabrication ID (FABNR) found – will not be able to upload data to DVI backend.")
-
-if SWBOT or SWTOP:
-    print(f"ℹ️ SW versions from .env: SWBOT={SWBOT or 'unknown'}, SWTOP={SWTOP or 'unknown'}")
-else:
-    print("ℹ️ No SWBOT/SWTOP set in .env")
-
-if INSTALL_DD and INSTALL_MM and INSTALL_YY:
-    print(f"ℹ️ Install date from .env: {INSTALL_DD}-{INSTALL_MM}-{INSTALL_YY}")
-else:
-    print("ℹ️ No install date (INDA) set in .env")
-
-if SERVICE_DD and SERVICE_MM and SERVICE_YY:
-    print(f"ℹ️ Service date from .env: {SERVICE_DD}-{SERVICE_MM}-{SERVICE_YY}")
-else:
-    print("ℹ️ No service date (SEDA) set in .env")
-
-# Modbus setup
-instrument = minimalmodbus.Instrument(serial_port, 0x10)
-instrument.serial.baudrate = 9600
-instrument.serial.bytesize = 8
-instrument.serial.parity = minimalmodbus.serial.PARITY_NONE
-instrument.serial.stopbits = 1
-instrument.serial.timeout = 2
-instrument.mode = minimalmodbus.MODE_RTU
-
-modbus_lock = threading.Lock()
+        self._report_started = now
+        self._report_cpu = time.process_time()
+        self._wakeups = 0
+        for task in self._tasks.values():
+            task["cpu"] = 0.0
+
+    def run_forever(self, after_cycle) -> None:
+        self.add("report", self.report_interval, self._report, delay=self.report_interval)
+        while True:
+            due = self._next_due()
+            timeout = None if due is None else max(0.0, due - time.monotonic())
+            self._wake.wait(timeout)
+            self._wake.clear()
+
+            wall_start = time.monotonic()
+            cpu_start = time.process_time()
+            self._wakeups += 1
+            for name, task in self._pop_due(wall_start):
+                task_cpu = time.process_time()
+                task_wall = time.monotonic()
+                try:
+                    task["func"]()
+                except Exception as e:
+                    print(f"⚠️ Poll task '{name}' failed: {e}")
+                task["cpu"] += time.process_time() - task_cpu
+                task["wall"] = time.monotonic() - task_wall
+            after_cycle()
+            self.last_cycle_cpu = time.process_time() - cpu_start
+            self.last_cycle_wall = time.monotonic() - wall_start
+            self.cycles += 1
+
+
+scheduler = PollScheduler()
 
 # Read credentials and broker info from environment variables
 MQTT_USER: Optional[str] = os.getenv("MQTT_USER") or None
@@ -118,22 +489,109 @@ mqtt_client.reconnect_delay_set(min_delay=1, max_delay=120)
 if MQTT_USER and MQTT_PASS:
     mqtt_client.username_pw_set(MQTT_USER, MQTT_PASS)
 
+# Publish counters for the /metrics endpoint
+mqtt_stats = {"messages": 0, "bytes": 0}
+_mqtt_publish = mqtt_client.publish
+
+def _counted_publish(topic, payload=None, *args, **kwargs):
+    mqtt_stats["messages"] += 1
+    if payload is not None:
+        mqtt_stats["bytes"] += len(payload.encode() if isinstance(payload, str) else payload)
+    return _mqtt_publish(topic, payload, *args, **kwargs)
+
+mqtt_client.publish = _counted_publish
+
 def _build_device_info() -> dict:
+    # Brug SWTOP som primær sw_version, ellers SWBOT
+    return _device_info(HEATPUMP_MODEL, PUMP_ID, SWTOP or SWBOT)
+
+@functools.lru_cache(maxsize=4)
+def _device_info(model: str, pump_id: Optional[str], sw: Optional[str]) -> dict:
+    """Built once per identity instead of once per discovery message (read-only, shared)."""
     device = {
-        "name": f"DVI {HEATPUMP_MODEL}",
-        "identifiers": [f"dvi_{HEATPUMP_MODEL.lower()}"],
+        "name": f"DVI {model}",
+        "identifiers": [f"dvi_{model.lower()}"],
         "manufacturer": "DVI",
-        "model": f"{HEATPUMP_MODEL} Heatpump"
+        "model": f"{model} Heatpump"
     }
-    if PUMP_ID:
-        device["identifiers"].append(f"pump_{PUMP_ID}")
-        device["serial_number"] = PUMP_ID
-    # Brug SWTOP som primær sw_version, ellers SWBOT
-    sw = SWTOP or SWBOT
+    if pump_id:
+        device["identifiers"].append(f"pump_{pump_id}")
+        device["serial_number"] = pump_id
     if sw:
         device["sw_version"] = sw
     return device
 
+# --- Discovery cache ---
+# Hash of every retained discovery config published, persisted across restarts, so
+# a broker reconnect or a restart only republishes the configs that changed: HA
+# reprocesses every config it receives. With DISCOVERY_VERIFY=1 the retained configs
+# on the broker are compared instead (catches a broker that lost its retained state).
+DISCOVERY_CACHE_PATH = os.getenv("DISCOVERY_CACHE", os.path.join(SCRIPT_DIR, "discovery.json"))
+DISCOVERY_VERIFY = os.getenv("DISCOVERY_VERIFY", "0") == "1"
+DISCOVERY_VERIFY_WAIT = 2.0  # seconds to collect the retained configs after subscribing
+# "entity": one config per entity (default, works with every HA version).
+# "device": one homeassistant/device/<id>/config with all components (HA 2024.11+).
+DISCOVERY_MODE = os.getenv("DISCOVERY_MODE", "entity").strip().lower()
+if DISCOVERY_MODE not in ("entity", "device"):
+    print(f"⚠️ Unknown DISCOVERY_MODE={DISCOVERY_MODE}, using entity")
+    DISCOVERY_MODE = "entity"
+discovery_lock = threading.Lock()  # MQTT connect and the static refresh task may both publish
+device_components: Optional[dict] = None  # collects the components while building the device config
+discovery_mode_done: Optional[str] = None  # mode whose old-mode configs were cleared on this broker
+discovery_check_pending = False  # start_discovery_verify() is collecting the retained configs
+discovery_hashes: dict = {}  # config topic -> sha1 of the payload last published
+broker_hashes: Optional[dict] = None  # while verifying: config topic -> sha1 of the retained payload
+discovery_stats = {"published": 0, "skipped": 0}
+
+def _payload_hash(payload: bytes) -> str:
+    return hashlib.sha1(payload).hexdigest()
+
+def load_discovery_cache() -> None:
+    try:
+        with open(DISCOVERY_CACHE_PATH, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        print(f"⚠️ Ignoring unreadable discovery cache {DISCOVERY_CACHE_PATH}: {e}")
+        return
+    global discovery_mode_done
+    if cache.get("broker") != f"{MQTT_HOST}:{MQTT_PORT}":
+        print("ℹ️ Discovery cache is for another broker, publishing all configs")
+        return
+    discovery_hashes.update(cache.get("configs", {}))
+    discovery_mode_done = cache.get("mode")
+
+def save_discovery_cache() -> None:
+    tmp_path = f"{DISCOVERY_CACHE_PATH}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"broker": f"{MQTT_HOST}:{MQTT_PORT}", "mode": discovery_mode_done,
+                       "configs": discovery_hashes}, f)
+        os.replace(tmp_path, DISCOVERY_CACHE_PATH)
+    except OSError as e:
+        print(f"⚠️ Could not write discovery cache {DISCOVERY_CACHE_PATH}: {e}")
+
+def publish_discovery_config(config_topic: str, payload: dict) -> bool:
+    """Publish one retained config unless the broker already has this exact payload."""
+    if device_components is not None:
+        # Device mode: same entity definition, collected as a component of the device config
+        component = {k: v for k, v in payload.items() if k not in ("device", "state_topic")}
+        component["platform"] = config_topic.split("/")[1]
+        device_components[payload["unique_id"]] = component
+        return False
+    msg = json.dumps(payload).encode("utf-8")
+    digest = _payload_hash(msg)
+    known = broker_hashes if broker_hashes is not None else discovery_hashes
+    if known.get(config_topic) == digest:
+        discovery_stats["skipped"] += 1
+        return False
+    if mqtt_client.publish(config_topic, msg, retain=True).rc != mqtt.MQTT_ERR_SUCCESS:
+        return False  # not connected: dropped, so not cached; on_connect publishes it again
+    discovery_hashes[config_topic] = digest
+    discovery_stats["published"] += 1
+    return True
+
 def publish_discovery_sensor(name, unique_id, value_template,
                              unit=None, device_class=None, entity_category=None, state_class=None):
     config_topic = f"homeassistant/sensor/{unique_id}/config"
@@ -148,8 +606,7 @@ def publish_discovery_sensor(name, unique_id, value_template,
     if device_class: payload["device_class"] = device_class
     if state_class: payload["state_class"] = state_class
     if entity_category: payload["entity_category"] = entity_category
-    msg = json.dumps(payload)
-    mqtt_client.publish(config_topic, msg, retain=True)
+    return publish_discovery_config(config_topic, payload)
 
 def publish_discovery_binary(name, unique_id, coil_key, device_class=None):
     config_topic = f"homeassistant/binary_sensor/{unique_id}/config"
@@ -166,7 +623,7 @@ def publish_discovery_binary(name, unique_id, coil_key, device_class=None):
     }
     if device_class:
         payload["device_class"] = device_class
-    mqtt_client.publish(config_topic, json.dumps(payload), retain=True)
+    return publish_discovery_config(config_topic, payload)
 
 def publish_discovery_number(name, unique_id, command_topic, state_template,
                              min_val=0, max_val=100, step=1, unit=None, entity_category=None):
@@ -185,7 +642,7 @@ def publish_discovery_number(name, unique_id, command_topic, state_template,
     }
     if unit: payload["unit_of_measurement"] = unit
     if entity_category: payload["entity_category"] = entity_category
-    mqtt_client.publish(config_topic, json.dumps(payload), retain=True)
+    return publish_discovery_config(config_topic, payload)
 
 def publish_discovery_select(name, unique_id, command_topic, state_template, options, entity_category=None):
     config_topic = f"homeassistant/select/{unique_id}/config"
@@ -200,281 +657,424 @@ def publish_discovery_select(name, unique_id, command_topic, state_template, opt
     }
     if entity_category:
         payload["entity_category"] = entity_category
-    msg = json.dumps(payload)
-    mqtt_client.publish(config_topic, msg, retain=True)
-
-# Coil mapping (coil 13 omitted)
-coil_names = {
-    0: "Soft starter Compressor",
-    1: "3-Way shunt VV open/close",
-    2: "Start/stop expansion valve",
-    3: "Heating element",
-    4: "Circ. pump warm side",
-    5: "El-tracing CV/drain",
-    8: "4-way valve defrost",
-    9: "Liquid injection solenoid valve",
-    10: "3-way shunt CV open",
-    11: "3-way shunt CV close",
-    12: "Circ. pump CV",
-    14: "Sum alarm failure"
-}
+    return publish_discovery_config(config_topic, payload)
 
-# FC04 sensor mapping and filtering
-omit_fc04 = {"sensor_4", "sensor_8", "sensor_9", "sensor_10", "sensor_13", "sensor_14"}
-fc04_labels = {
-    "sensor_1": "CV Forward",
-    "sensor_2": "CV Return",
-    "sensor_3": "Storage tank VV",
-    "sensor_5": "Storage tank CV",
-    "sensor_6": "Evaporator",
-    "sensor_7": "Outdoor",
-    "sensor_11": "Compressor HP",
-    "sensor_12": "Compressor LP"
-}
+COILS = [reg for reg in REGISTERS if reg.function == FC_COILS]
 
 # Modbus-safe wrappers
 def read_coils():
+    if register_health.skip(1, COIL_BLOCK[0]):
+        return {}
     try:
-        with modbus_lock:
-            payload = struct.pack('>HH', 0x0001, 0x000E)
-            response = instrument._perform_command(1, payload)
-
-        if len(response) < 3 or response[0] != 2:
-            raise ValueError("FC01 response malformed")
-
-        bitmask = (response[2] << 8) | response[1]
-        bits = [(bitmask >> i) & 1 for i in range(16)]
-
-        return dict(sorted({coil_names[i]: bits[i] for i in coil_names}.items()))
+        bits = modbus_call(1, COIL_BLOCK[0], transport.read_bits, *COIL_BLOCK)
+        return dict(sorted({reg.key: bits[reg.address] for reg in COILS}.items()))
     except Exception as e:
         print(f"FC01 read failed: {e}")
         return {}
 
 def read_input(register, signed=False):
+    if register_health.skip(4, register):
+        return None
     try:
-        with modbus_lock:
-            return instrument.read_register(register, number_of_decimals=0, functioncode=4, signed=signed)
+        value = modbus_call(4, register, transport.read_registers, register, 1)[0]
+        return value - 0x10000 if signed and value & 0x8000 else value
     except Exception as e:
         print(f"FC04 read failed for 0x{register:02X}: {e}")
         return None
 
+# Whether the STM32 bridge answers a multi-register FC04 read, per span start
+# (missing = not probed yet): one span being rejected says nothing about the others
+fc04_block_supported: dict = {}
+
+def read_registers_block(start, count, functioncode=4, signed=False, probe=False) -> Optional[list]:
+    """
+    Returns None when the read failed; re-raises the SlaveReportedException when
+    the controller rejected the request (illegal function/address), so callers
+    can tell a block read that is not supported from a timeout or a damaged reply.
+    """
+    if not probe and register_health.skip(functioncode, start, count):
+        return None
+    call = probe_call if probe else functools.partial(modbus_call, count=count)
+    try:
+        values = call(functioncode, start, transport.read_registers, start, count, functioncode)
+    except Exception as e:
+        print(f"FC{functioncode:02d} block read failed for 0x{start:02X}-0x{start + count - 1:02X}: {e}")
+        if isinstance(e, SlaveReportedException) and e.rejected:
+            raise
+        return None
+    if signed:
+        values = [v - 0x10000 if v & 0x8000 else v for v in values]
+    return values
+
+def read_input_range(start, count, signed=False, addresses=None) -> tuple:
+    """
+    Read a contiguous FC04 range; returns ({register: value} for the registers
+    that answered, whether it came from one block read). Uses a single
+    transaction when the STM32 bridge supports block reads of this range
+    (probed on first use), otherwise one read per register in addresses
+    (default: the whole range). A block read that keeps failing while the
+    single reads answer (a dead register inside the span) is quarantined by
+    register_health, and the span is read per register until its backoff ends.
+    """
+    supported = fc04_block_supported.get(start)
+    if supported is not False and not register_health.skip(4, start, count):
+        # Only an exception reply rules block reads out. A failed probe with a timeout
+        # or a damaged reply says nothing, so read per register now and probe again next cycle.
+        try:
+            values = read_registers_block(start, count, signed=signed)
+        except SlaveReportedException:
+            print(f"ℹ️ STM32 bridge rejected the FC04 block read of 0x{start:02X}-0x{start + count - 1:02X}, "
+                  "falling back to per-register reads")
+            fc04_block_supported[start] = False
+        else:
+            if values is not None:
+                if supported is None:
+                    print(f"✅ STM32 bridge answers FC04 block reads of 0x{start:02X}-0x{start + count - 1:02X}, "
+                          "using block reads")
+                fc04_block_supported[start] = True
+                return {start + i: val for i, val in enumerate(values)}, True
+            if supported:
+                return {}, False  # transient failure, keep the cached values
+
+    result = {}
+    registers = addresses or range(start, start + count)
+    for reg in registers:
+        val = read_input(reg, signed=signed)
+        if val is not None:
+            result[reg] = val
+    return result, False
+
 def read_via_fc06(register, signed=False):
+    if register_health.skip(6, register):
+        return None
     try:
-        with modbus_lock:
-            payload = struct.pack('>HH', register, 0x0000)
-            response = instrument._perform_command(6, payload)
-            _, value = struct.unpack('>HH', response)
-            if signed:
-                value = struct.unpack('>h', struct.pack('>H', value))[0]
-            return value
+        value = modbus_call(6, register, transport.echo_read, register)
+        if signed:
+            value = struct.unpack('>h', struct.pack('>H', value))[0]
+        return value
     except Exception as e:
         print(f"FC06 echo failed for 0x{register:02X}: {e}")
         return None
 
-def write_fc06(register, value):
-    payload = struct.pack('>HH', register, value)
+def write_fc06(register, value) -> bool:
     try:
-        with modbus_lock:
-            instrument._perform_command(6, payload)  # Don't store or parse response
+        modbus_call(6, register, transport.write_register, register, value)  # Don't store or parse response
         print(f"✅ FC06 write sent: reg={register}, value={value}")
+        return True
     except Exception as e:
         print(f"❌ FC06 write failed: {e}")
+        return False
 
     # Store  raw values
+# --- Central heating config cache ---
+# The curve point addresses depend on central_heating_config (0x1A). It only
+# changes when written, so curve commands and curve polling resolve through
+# this cache instead of an extra FC06 round trip each time.
+HEATING_CONFIG_REGISTER = REGISTERS_BY_KEY["central_heating_config"]
+HEATING_CONFIG_TTL = 600.0  # seconds before the cached value is re-read
+
+heating_config = {"value": None, "read_at": 0.0}
+
+def remember_heating_config(raw_val: int) -> None:
+    heating_config.update(value=raw_val, read_at=time.monotonic())
+    last_writes["central_heating_config_raw"] = raw_val
+
+def invalidate_heating_config() -> None:
+    heating_config["value"] = None
+
+def current_heating_config() -> Optional[int]:
+    """Cached central heating config, read via FC06 echo when missing or expired."""
+    if heating_config["value"] is not None and time.monotonic() - heating_config["read_at"] < HEATING_CONFIG_TTL:
+        return heating_config["value"]
+    started = time.monotonic()
+    raw_val = read_via_fc06(HEATING_CONFIG_REGISTER.address)
+    if raw_val is None:
+        print("⚠️ Could not read 0x1A to resolve curve register")
+        return None
+    store_setting(HEATING_CONFIG_REGISTER, raw_val, started)
+    return raw_val
+
+def store_setting(reg, raw: int, started: Optional[float] = None) -> None:
+    """Decode a settings register into last_writes, stamped if the read was timed."""
+    last_writes[reg.key] = reg.decode(raw)
+    keys = (reg.key,)
+    if reg is HEATING_CONFIG_REGISTER:
+        remember_heating_config(raw)
+        keys += ("central_heating_config_raw",)
+    note_acquired(keys, started, reg.key)
+
 def resolve_curve_register(which: str) -> Optional[dict]:
     """
     which: "-12" or "12"
     Returns {'read': int, 'write': int} for the current central heating config (0x1A).
     """
-    raw_val = read_via_fc06(0x1A)
+    raw_val = current_heating_config()
     if raw_val is None:
-        print("⚠️ Could not read 0x1A to resolve curve register")
         return None
 
-    last_writes["central_heating_config_raw"] = raw_val
-
-    if raw_val == 0:
-        # write: 0x12F / 0x130 → read: 0x02F / 0x030
-        write_map = {"12": 0x12F, "-12": 0x130}
-        read_map  = {"12": 0x2F,  "-12": 0x30}
-    elif raw_val == 1:
-        # write: 0x131 / 0x132 → read: 0x031 / 0x032
-        write_map = {"12": 0x131, "-12": 0x132}
-        read_map  = {"12": 0x31,  "-12": 0x32}
-    elif raw_val == 2:
-        # write: 0x133 / 0x134 → read: 0x033 / 0x034
-        write_map = {"12": 0x133, "-12": 0x134}
-        read_map  = {"12": 0x33,  "-12": 0x34}
-    else:
+    points = CURVE_REGISTERS.get(raw_val)
+    if points is None:
         print(f"⚠️ Unknown 0x01A value {raw_val}, cannot resolve curve register")
         return None
 
-    if which not in write_map:
+    if which not in points:
         print(f"⚠️ Unknown curve selector '{which}'")
         return None
 
-    return {"read": read_map[which], "write": write_map[which]}
+    read_reg, write_reg = points[which]
+    return {"read": read_reg, "write": write_reg}
 
 
 # --- MQTT command handling for Modbus writes ---
-command_map = {
-    "dvi/command/cvstate": {"register": 0x101, "scale": 1},
-    "dvi/command/cvcurve": {"register": 0x102, "scale": 1},
-    "dvi/command/cvnight": {"register": 0x104, "scale": 1},
-    "dvi/command/vvstate": {"register": 0x10A, "scale": 1},
-    "dvi/command/vvsetpoint": {"register": 0x10B, "scale": 1},
-    "dvi/command/vvschedule": {"register": 0x10C, "scale": 1},
-    "dvi/command/tvstate": {"register": 0x10F, "scale": 1},
-    "dvi/command/centralheatingconfig": {"register": 0x11A, "scale": 1},
-    "dvi/command/cvmax": {"register": 0x11B, "scale": 1},
-    "dvi/command/cvmin": {"register": 0x11C, "scale": 1},
-#    "dvi/command/outdoorcal": {"register": 0x18D, "scale": 1}, 
-    "dvi/command/curveset-12": {"dynamic_curve": "-12", "scale": 1},
-    "dvi/command/curveset12": {"dynamic_curve": "12", "scale": 1},
-}
 
-# Map string payloads from HA selects to numeric register values
-select_map = {
-    "dvi/command/cvstate": {"Off": 0, "On": 1},
-    "dvi/command/vvstate": {"Off": 0, "On": 1},   # adjust if you add "Timer"
-    "dvi/command/cvnight": {"Timer": 0, "Constant day": 1, "Constant night": 2},
-    "dvi/command/vvschedule": {"Timer": 0, "Constant on": 1, "Constant off": 2},
-    "dvi/command/tvstate": {"Off": 0, "Automatic": 1, "Backup operation": 2},
-    "dvi/command/centralheatingconfig": {"Under floor heating w/o shunt": 0,
-                                           "Under floor heating w. shunt": 1,
-                                           "Radiator and mixed systems": 2}
-}
+def handle_command(reg, value_raw, topic, received: float) -> None:
+    """Runs on the bus thread, ahead of any queued poll reads."""
+    # Dynamic curve register resolution
+    if reg.curve:
+        reg_info = resolve_curve_register(reg.curve)
+        if reg_info is None:
+            print(f"❌ Could not resolve register for {topic}")
+            return
+        print(f"Writing dynamic curve register 0x{reg_info['write']:02X} with value {value_raw}")
+        if not write_fc06(reg_info["write"], value_raw):
+            command_write_failed(topic, value_raw)
+            return
+        print(f"✅ FC06 write: topic={topic} value={value_raw} reg=0x{reg_info['write']:02X}")
+        read_back(reg, value_raw, received)
+        return
+
+    # Static writes
+    if reg is HEATING_CONFIG_REGISTER:
+        invalidate_heating_config()  # curve addresses move with the new config
+    print(f"Writing to register {reg.write_address} with value {value_raw}")
+    if not write_fc06(reg.write_address, value_raw):
+        command_write_failed(topic, value_raw)
+        return
+    print(f"✅ FC06 write: topic={topic} value={value_raw} reg=0x{reg.write_address:02X}")
+    read_back(reg, value_raw, received)
+
+def command_write_failed(topic, value_raw) -> None:
+    """Nothing to read back: the state did not change, and calling it a mismatch would hide the failure."""
+    with pending_lock:
+        command_stats["failed"] += 1
+    print(f"❌ Command {topic}={value_raw} not applied, the write failed")
+
+# HA number sliders send a burst of commands while dragging. Each register has
+# one pending-write slot: a new command replaces the queued value and the write
+# goes out once the topic has been quiet for COMMAND_QUIET_WINDOW seconds (or
+# COMMAND_MAX_DELAY after the first command of a never-ending burst).
+COMMAND_QUIET_WINDOW = float(os.getenv("COMMAND_QUIET_WINDOW", "0.5"))
+COMMAND_MAX_DELAY = 2.0
+
+pending_writes = {}  # reg.key -> {"reg", "value", "topic", "first", "received", "timer"}
+pending_lock = threading.Lock()
+command_stats = {"received": 0, "written": 0, "coalesced": 0, "failed": 0,
+                 "confirmed": 0, "mismatched": 0, "latency_total": 0.0, "latency_max": 0.0}
+
+def queue_command(reg, value_raw, topic) -> None:
+    """Park the command in the register's slot and (re)start its quiet window."""
+    now = time.monotonic()
+    with pending_lock:
+        command_stats["received"] += 1
+        slot = pending_writes.get(reg.key)
+        if slot is None:
+            slot = pending_writes[reg.key] = {"first": now, "received": 0, "timer": None}
+        else:
+            slot["timer"].cancel()
+            command_stats["coalesced"] += 1
+        slot.update(reg=reg, value=value_raw, topic=topic, last=now)
+        slot["received"] += 1
+        delay = min(COMMAND_QUIET_WINDOW, max(0.0, slot["first"] + COMMAND_MAX_DELAY - now))
+        slot["timer"] = threading.Timer(delay, flush_command, args=(reg.key,))
+        slot["timer"].daemon = True
+        slot["timer"].start()
+
+def flush_command(key: str) -> None:
+    """Quiet window over: queue the latest value of the slot on the bus."""
+    with pending_lock:
+        slot = pending_writes.pop(key, None)
+        if slot is None:
+            return
+        command_stats["written"] += 1
+    if slot["received"] > 1:
+        print(f"🔀 Coalesced {slot['received']} commands on {slot['topic']} into one write of {slot['value']}")
+    bus.submit(PRIORITY_COMMAND, handle_command, slot["reg"], slot["value"], slot["topic"], slot["last"])
+
+def report_commands() -> dict:
+    with pending_lock:
+        stats = dict(command_stats)
+    if stats["received"]:
+        checked = stats["confirmed"] + stats["mismatched"]
+        latency = f"avg {1000 * stats['latency_total'] / checked:.0f}ms max {1000 * stats['latency_max']:.0f}ms" if checked else "n/a"
+        print(f"🔀 Commands: {stats['received']} received, {stats['written']} written, "
+              f"{stats['coalesced']} coalesced, {stats['failed']} failed, {stats['confirmed']} confirmed, "
+              f"{stats['mismatched']} not confirmed; command to confirmed state {latency}")
+    return stats
 
 def on_message(client, userdata, msg):
     try:
         topic = msg.topic
         payload_str = msg.payload.decode().strip()
-        cfg = command_map.get(topic)
-        if not cfg:
+        reg = COMMAND_REGISTERS.get(topic)
+        if reg is None:
             return
 
-        # Handle HA Select payloads (e.g. "Off", "On", "Automatic")
-        if topic in select_map:
-            if payload_str not in select_map[topic]:
-                print(f"⚠️ Unknown select option '{payload_str}' for topic {topic}")
-                return
-            value_raw = select_map[topic][payload_str]
-        else:
-            value_raw = int(payload_str)
-
-        # Dynamic curve register resolution
-        if "dynamic_curve" in cfg:
-            reg_info = resolve_curve_register(cfg["dynamic_curve"])
-            if reg_info is None:
-                print(f"❌ Could not resolve register for {topic}")
-                return
-            print(f"Writing dynamic curve register 0x{reg_info['write']:02X} with value {value_raw}")
-            write_fc06(reg_info["write"], value_raw)
-            print(f"✅ FC06 write: topic={topic} value={value_raw} reg=0x{reg_info['write']:02X}")
+        # HA select payloads (e.g. "Off", "On", "Automatic") or plain numbers
+        value_raw = reg.command_value(payload_str)
+        if value_raw is None:
+            print(f"⚠️ Unknown select option '{payload_str}' for topic {topic}")
             return
 
-        # Static writes
-        scaled = value_raw * cfg.get("scale", 1)
-        print(f"Writing to register {cfg['register']} with value {scaled}")
-        write_fc06(cfg["register"], scaled)
-        print(f"✅ FC06 write: topic={topic} value={value_raw} reg=0x{cfg['register']:02X}")
+        # Queue the write on the bus; never block the MQTT network thread
+        if COMMAND_QUIET_WINDOW > 0:
+            queue_command(reg, value_raw, topic)
+        else:
+            with pending_lock:
+                command_stats["received"] += 1
+                command_stats["written"] += 1
+            bus.submit(PRIORITY_COMMAND, handle_command, reg, value_raw, topic, time.monotonic())
 
     except Exception as e:
         print(f"❌ Command handling failed for {msg.topic}: {e}")
 
-# --- FC06 registers discovery ---
-
-fc06_registers = {
-    0x01: "cv_mode",
-    0x02: "cv_curve",
-    0x03: "cv_setpoint",
-    0x04: "cv_night",
-    0x0A: "vv_mode",
-    0x0B: "vv_setpoint",
-    0x0C: "vv_schedule",
-    0x0F: "aux_heating",
-    0xA1: "comp_hours",
-    0xA2: "vv_hours",
-    0xA3: "heating_hours",
-    0xD0: "curve_temp",
-    0x1A: "central_heating_config",
-    0x1B: "cv_max",
-    0x1C: "cv_min",
-    0x8D: "outdoor_cal"
-}
-
-# Special FC06 sensor definitions
-special_fc06 = {
-    "comp_hours": {
-        "unit": "h",
-        "device_class": "duration",
-        "state_class": "total_increasing"
-    },
-    "vv_hours": {
-        "unit": "h",
-        "device_class": "duration",
-        "state_class": "total_increasing"
-    },
-    "heating_hours": {
-        "unit": "h",
-        "device_class": "duration",
-        "state_class": "total_increasing"
-    }
-}
-
-# Define the valid options for each mode register
-mode_options = {
-    "cv_mode": ["Off", "On"],
-    "cv_night": ["Timer", "Constant day", "Constant night"],
-    "vv_mode": ["Off", "On", "Timer"],
-    "vv_schedule": ["Timer", "Constant on", "Constant off"],
-    "aux_heating": ["Off", "Automatic", "On"],
-    "central_heating_config": ["Under floor heating w/o shunt",
-                               "Under floor heating w. shunt",
-                               "Radiator and mixed systems"]
-}
+# --- Discovery generated from the register map ---
+
+def _state_template(reg) -> str:
+    if reg.value_template:
+        return reg.value_template
+    key = reg.state_key or reg.key
+    if reg.options is not None:
+        return f"{{% set map = {reg.options} %}}{{{{ map[value_json.{reg.section}['{key}']] }}}}"
+    return f"{{{{ value_json.{reg.section}['{key}'] }}}}"
+
+def publish_register_discovery(reg) -> bool:
+    """True if the config was (re)published, False if the broker already has it."""
+    name = reg.name or reg.key
+    if reg.component == "binary_sensor":
+        return publish_discovery_binary(name=name, unique_id=reg.unique_id, coil_key=reg.key)
+    elif reg.component == "select":
+        return publish_discovery_select(
+            name=name,
+            unique_id=reg.unique_id,
+            command_topic=reg.command_topic,
+            state_template=_state_template(reg),
+            options=list(reg.options.values()),
+            entity_category=reg.entity_category
+        )
+    elif reg.component == "number":
+        return publish_discovery_number(
+            name=name,
+            unique_id=reg.unique_id,
+            command_topic=reg.command_topic,
+            state_template=_state_template(reg),
+            min_val=reg.min_val,
+            max_val=reg.max_val,
+            step=reg.step,
+            unit=reg.unit,
+            entity_category=reg.entity_category
+        )
+    else:
+        return publish_discovery_sensor(
+            name=name,
+            unique_id=reg.unique_id,
+            value_template=_state_template(reg),
+            unit=reg.unit,
+            device_class=reg.device_class,
+            entity_category=reg.entity_category,
+            state_class=reg.state_class
+        )
 
-# --- Samlet discovery-funktion (placeret EFTER fc06_registers/special_fc06/mode_options) ---
+def _device_discovery_topic() -> str:
+    return f"homeassistant/device/{_build_device_info()['identifiers'][0]}/config"
 
-def publish_all_discovery() -> None:
-    """Publish alle Home Assistant discovery configs (kaldes ved hver MQTT connect)."""
+def _migrate_discovery(topics) -> None:
+    """Tell HA that these configs move to the other discovery mode, so the entities are kept."""
+    for topic in topics:
+        mqtt_client.publish(topic, json.dumps({"migrate_discovery": True}), retain=True)
 
-    # Coils -> binary_sensors
-    for idx, label in coil_names.items():
-        publish_discovery_binary(
-            name=label,
-            unique_id=f"dvi_coil_{idx}",
-            coil_key=label
-        )
+def _clear_discovery(topics) -> bool:
+    cleared = True
+    for topic in topics:
+        if mqtt_client.publish(topic, "", retain=True).rc == mqtt.MQTT_ERR_SUCCESS:
+            discovery_hashes.pop(topic, None)
+        else:
+            cleared = False
+    return cleared
 
-    # FC04 sensors -> temperature sensors
-    for key, label in fc04_labels.items():
-        publish_discovery_sensor(
-            name=label,
-            unique_id=f"dvi_fc04_{key}",
-            value_template=f"{{{{ value_json.input_registers['{label}'] }}}}",
-            unit="°C",
-            device_class="temperature",
-            state_class="measurement"
-        )
+def _entity_components() -> dict:
+    """unique_id -> component, from the same definitions the per-entity mode publishes."""
+    global device_components
+    device_components = {}
+    try:
+        _publish_entity_discovery()
+        return device_components
+    finally:
+        device_components = None
+
+def _other_mode_topics() -> list:
+    """Config topics the other discovery mode would have used (from the register map, no cache needed)."""
+    if DISCOVERY_MODE == "device":
+        return [f"homeassistant/{c['platform']}/{uid}/config" for uid, c in _entity_components().items()]
+    return [_device_discovery_topic()]
+
+def publish_all_discovery(checked: bool = False) -> None:
+    """
+    Publish de Home Assistant discovery configs der er ændret (kaldes ved hver MQTT connect).
+    checked: called after start_discovery_verify() collected the retained configs in broker_hashes.
+    """
+    global discovery_mode_done
+    with discovery_lock:
+        if discovery_check_pending and not checked:
+            return  # finish_discovery_verify() publishes in a moment
+        before = dict(discovery_stats)
+        device_topic = _device_discovery_topic()
+        components = _entity_components() if DISCOVERY_MODE == "device" else None
+        # Only migrate configs of the other mode that are actually retained on the
+        # broker (or, without a broker check, that this install published itself)
+        stale = []
+        done_before = discovery_mode_done
+        migrating = discovery_mode_done != DISCOVERY_MODE
+        if migrating:
+            owned = broker_hashes if checked else discovery_hashes
+            stale = [topic for topic in _other_mode_topics() if topic in owned]
+        if stale:
+            print(f"🔀 Migrating discovery to {DISCOVERY_MODE} mode, clearing {len(stale)} old configs")
+            _migrate_discovery(stale)
+
+        if DISCOVERY_MODE == "device":
+            _publish_device_discovery(device_topic, components)
+        else:
+            _publish_entity_discovery()
+        if _clear_discovery(stale) and migrating and checked:
+            discovery_mode_done = DISCOVERY_MODE
+
+        published = discovery_stats["published"] - before["published"]
+        skipped = discovery_stats["skipped"] - before["skipped"]
+        print(f"🟢 Discovery: {published} configs published, {skipped} unchanged and skipped")
+        if published or stale or discovery_mode_done != done_before:
+            save_discovery_cache()
+
+def _publish_device_discovery(device_topic: str, components: dict) -> None:
+    """All entities in one retained device config; the shared device block and state topic are sent once."""
+    payload = {
+        "device": _build_device_info(),
+        "origin": {"name": "dvi-bridge-standalone"},
+        "state_topic": "dvi/measurement",
+        "components": components,
+    }
+    if publish_discovery_config(device_topic, payload):
+        print(f"🟢 Published device discovery: {len(components)} components -> {device_topic}")
 
-    # Special FC04 cases
-    publish_discovery_sensor(
-        name="em23_power",
-        unique_id="dvi_fc04_power",
-        value_template="{{ value_json.input_registers['em23_power'] | float | round(3) }}",
-        unit="kW",
-        device_class="power",
-        state_class="measurement"
-    )
-    publish_discovery_sensor(
-        name="em23_energy",
-        unique_id="dvi_fc04_energy",
-        value_template="{{ value_json.input_registers['em23_energy'] }}",
-        unit="kWh",
-        device_class="energy",
-        state_class="total_increasing"
-    )
+def _publish_entity_discovery() -> None:
+    for reg in REGISTERS:
+        if reg.component is None:
+            continue
+        try:
+            if publish_register_discovery(reg) and reg.function == FC_ECHO:
+                target = f" -> {reg.command_topic}" if reg.command_topic else ""
+                print(f"🟢 Published {reg.component} discovery: {reg.key}{target}")
+        except Exception as e:
+            print(f"⚠️ Discovery generation failed for {reg.key}: {e}")
 
     # Install / service date as diagnostic sensors
     publish_discovery_sensor(
@@ -490,206 +1090,37 @@ def publish_all_discovery() -> None:
         entity_category="diagnostic"
     )
 
-    # FC06 discovery
-    for reg, label in fc06_registers.items():
-        try:
-            if label in mode_options:
-                cmd_topic = {
-                    "cv_mode": "dvi/command/cvstate",
-                    "cv_night": "dvi/command/cvnight",
-                    "vv_mode": "dvi/command/vvstate",
-                    "vv_schedule": "dvi/command/vvschedule",
-                    "aux_heating": "dvi/command/tvstate",
-                    "central_heating_config": "dvi/command/centralheatingconfig"
-                }[label]
-
-                mapping = {
-                    "cv_mode": {0: "Off", 1: "On"},
-                    "cv_night": {0: "Timer", 1: "Constant day", 2: "Constant night"},
-                    "vv_mode": {0: "Off", 1: "On"},
-                    "vv_schedule": {0: "Timer", 1: "Constant on", 2: "Constant off"},
-                    "aux_heating": {0: "Off", 1: "Automatic", 2: "On"},
-                    "central_heating_config": {
-                        0: "Under floor heating w/o shunt",
-                        1: "Under floor heating w. shunt",
-                        2: "Radiator and mixed systems"
-                    }
-                }[label]
-
-                if label == "central_heating_config":
-                    publish_discovery_select(
-                        name=label,
-                        unique_id=f"dvi_fc06_{label}",
-                        command_topic=cmd_topic,
-                        state_template=f"""
-                          {{% set map = {mapping} %}}
-                          {{{{ map[value_json.write_registers['{label}']] }}}}
-                        """,
-                        options=mode_options[label],
-                        entity_category="config"
-                    )
-                else:
-                    publish_discovery_select(
-                        name=label,
-                        unique_id=f"dvi_fc06_{label}",
-                        command_topic=cmd_topic,
-                        state_template=f"""
-                          {{% set map = {mapping} %}}
-                          {{{{ map[value_json.write_registers['{label}']] }}}}
-                        """,
-                        options=mode_options[label]
-                   )
-                print(f"🟢 Published select discovery: {label} -> {cmd_topic}")
-
-            elif label == "cv_curve":
-                publish_discovery_number(
-                    name=label,
-                    unique_id=f"dvi_fc06_{label}",
-                    command_topic="dvi/command/cvcurve",
-                    state_template=f"{{{{ value_json.write_registers['{label}'] }}}}",
-                    min_val=1,
-                    max_val=20,
-                    step=1
-                )
-                print(f"🟢 Published number discovery: {label} -> dvi/command/cvcurve")
-
-            elif label == "vv_setpoint":
-                publish_discovery_number(
-                    name=label,
-                    unique_id=f"dvi_fc06_{label}",
-                    command_topic="dvi/command/vvsetpoint",
-                    state_template=f"{{{{ value_json.write_registers['{label}'] }}}}",
-                    min_val=10,
-                    max_val=60,
-                    step=1,
-                    unit="°C"
-                )
-                print(f"🟢 Published number discovery: {label} -> dvi/command/vvsetpoint")
-
-            elif label == "cv_max":
-                publish_discovery_number(
-                    name=label,
-                    unique_id=f"dvi_fc06_{label}",
-                    command_topic="dvi/command/cvmax",
-                    state_template=f"{{{{ value_json.write_registers['{label}'] }}}}",
-                    min_val=20,
-                    max_val=55,
-                    step=1,
-                    unit="°C",
-                    entity_category="config"
-                )
-                print(f"🟢 Published number discovery: {label} -> dvi/command/cvmax")
-
-            elif label == "cv_min":
-                publish_discovery_number(
-                    name=label,
-                    unique_id=f"dvi_fc06_{label}",
-                    command_topic="dvi/command/cvmin",
-                    state_template=f"{{{{ value_json.write_registers['{label}'] }}}}",
-                    min_val=10,
-                    max_val=45,
-                    step=1,
-                    unit="°C",
-                    entity_category="config"
-                )
-                print(f"🟢 Published number discovery: {label} -> dvi/command/cvmin")
-
-#            elif label == "outdoor_cal":
-#                publish_discovery_number(
-#                    name=label,
-#                    unique_id=f"dvi_fc06_{label}",
-#                    command_topic="dvi/command/outdoorcal",
-#                    state_template=f"{{{{ value_json.write_registers['{label}'] }}}}",
-#                    min_val=-5,
-#                    max_val=5,
-#                    step=1,
-#                    unit="°C",
-#                    entity_category="config"
-#                )
-#                print(f"🟢 Published number discovery: {label} -> dvi/command/outdoorcal")#
-
-            elif label == "outdoor_cal":
-                publish_discovery_sensor(
-                    name=label,
-                    unique_id=f"dvi_fc06_{label}",
-                    value_template=f"{{{{ value_json.write_registers['{label}'] }}}}",
-                    unit="°C",
-                    device_class="temperature",
-                    state_class="measurement"
-                )
-                print(f"🟢 Published sensor discovery: {label}")
-
-            elif label == "curve_temp":
-                publish_discovery_sensor(
-                    name=label,
-                    unique_id=f"dvi_fc06_{label}",
-                    value_template=f"{{{{ value_json.write_registers['{label}'] }}}}",
-                    unit="°C",
-                    device_class="temperature",
-                    state_class="measurement"
-                )
-                print(f"🟢 Published sensor discovery: {label}")
-
-            elif label == "cv_setpoint":
-                publish_discovery_sensor(
-                    name=label,
-                    unique_id=f"dvi_fc06_{label}",
-                    value_template=f"{{{{ value_json.write_registers['{label}'] }}}}",
-                    unit="°C",
-                    device_class="temperature",
-                    state_class="measurement"
-                )
-                print(f"🟢 Published sensor discovery: {label}")
-
-            elif label in special_fc06:
-                cfg = special_fc06[label]
-                publish_discovery_sensor(
-                    name=label,
-                    unique_id=f"dvi_fc06_{label}",
-                    value_template=f"{{{{ value_json.write_registers['{label}'] }}}}",
-                    unit=cfg.get("unit"),
-                    device_class=cfg.get("device_class"),
-                    state_class=cfg.get("state_class")
-                )
-                print(f"🟢 Published sensor discovery: {label}")
-
-            else:
-                publish_discovery_sensor(
-                    name=label,
-                    unique_id=f"dvi_fc06_{label}",
-                    value_template=f"{{{{ value_json.write_registers['{label}'] }}}}",
-                    state_class="measurement"
-                )
-                print(f"🟢 Published sensor discovery: {label}")
-
-        except Exception as e:
-            print(f"⚠️ Discovery generation failed for {label}: {e}")
-
-    publish_discovery_number(
-        name="curve_set_-12",
-        unique_id="dvi_fc06_curve_set_-12",
-        command_topic="dvi/command/curveset-12",
-        state_template="{{ value_json.write_registers['curve_set_-12_read'] }}",
-        min_val=10,
-        max_val=80,
-        step=1,
-        unit="°C",
-        entity_category="config"
-    )
-    print("🟢 Published number discovery: curve_set_-12 -> dvi/command/curveset-12")
-
-    publish_discovery_number(
-        name="curve_set_12",
-        unique_id="dvi_fc06_curve_set_12",
-        command_topic="dvi/command/curveset12",
-        state_template="{{ value_json.write_registers['curve_set_12_read'] }}",
-        min_val=10,
-        max_val=80,
-        step=1,
-        unit="°C",
-        entity_category="config"
-    )
-    print("🟢 Published number discovery: curve_set_12 -> dvi/command/curveset12")
+def start_discovery_verify(client) -> None:
+    """
+    Subscribe to our config topics, and to the other mode's while a mode
+    migration is pending; the broker answers with what it has retained.
+    """
+    global broker_hashes, discovery_check_pending
+    with discovery_lock:
+        topics = set(discovery_hashes)
+        if discovery_mode_done != DISCOVERY_MODE:
+            topics.update(_other_mode_topics())
+        broker_hashes = {}
+        discovery_check_pending = True
+    for topic in topics:
+        client.subscribe(topic)
+    threading.Timer(DISCOVERY_VERIFY_WAIT, finish_discovery_verify, args=(client, topics)).start()
+
+def finish_discovery_verify(client, topics) -> None:
+    global broker_hashes, discovery_check_pending
+    missing = sum(1 for topic in discovery_hashes if topic not in broker_hashes)
+    if missing:
+        print(f"ℹ️ Broker lost {missing} retained discovery configs, republishing them")
+    publish_all_discovery(checked=True)
+    for topic in topics:
+        client.unsubscribe(topic)
+    with discovery_lock:
+        broker_hashes = None
+        discovery_check_pending = False
+
+def on_discovery_message(client, userdata, msg) -> None:
+    if broker_hashes is not None and msg.payload:
+        broker_hashes[msg.topic] = _payload_hash(msg.payload)
 
 
 # --- MQTT callbacks (EFTER publish_all_discovery er defineret) --------------
@@ -697,16 +1128,21 @@ def publish_all_discovery() -> None:
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
         print("✅ Connected to MQTT broker")
-        for t in command_map:
+        for t in COMMAND_REGISTERS:
             client.subscribe(t)
-        publish_all_discovery()
+        if (DISCOVERY_VERIFY and discovery_hashes) or discovery_mode_done != DISCOVERY_MODE:
+            start_discovery_verify(client)
+        else:
+            publish_all_discovery()
     else:
         print(f"❌ MQTT connection failed with code {rc}")
 
 mqtt_client.on_connect = on_connect
-for t in command_map:
+for t in COMMAND_REGISTERS:
     mqtt_client.subscribe(t)
 mqtt_client.on_message = on_message
+mqtt_client.message_callback_add("homeassistant/+/+/config", on_discovery_message)
+load_discovery_cache()
 
 # --- Netværksinfo helpers (replikeret fra functions.py) ---------------------
 
@@ -722,7 +1158,6 @@ def _get_default_gateway_linux() -> list[str]:
                 g = socket.inet_ntoa(struct.pack("<L", int(fields[2], 16)))
                 parts = g.split(".")
                 if len(parts) == 4:
-                    print(f"ℹ️ Detected default gateway from /proc/net/route: {g}")
                     return parts
     except Exception as e:
         print(f"⚠️ Failed to read default gateway: {e}")
@@ -730,208 +1165,586 @@ def _get_default_gateway_linux() -> list[str]:
 
 
 def _get_default_dns_linux() -> list[str]:
-    """Returnerer DNS som liste [a,b,c,d] eller ['0','0','0','0'] ved fejl."""
+    """Første IPv4 nameserver i /etc/resolv.conf som [a,b,c,d], ellers ['0','0','0','0']."""
     try:
-        data = subprocess.check_output(
-            "cat /etc/resolv.conf | grep -im 1 '^nameserver' | cut -d ' ' -f2",
-            shell=True,
-        ).decode("utf-8").strip()
-        if not data:
-            data = "0.0.0.0"
-    except Exception as e:
+        with open("/etc/resolv.conf") as fh:
+            for line in fh:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0].lower() == "nameserver":
+                    parts = fields[1].split(".")
+                    if len(parts) == 4:
+                        return parts
+    except OSError as e:
         print(f"⚠️ Failed to read DNS from /etc/resolv.conf: {e}")
-        data = "0.0.0.0"
-    parts = data.split(".")
-    if len(parts) != 4:
-        return ["0", "0", "0", "0"]
-    return parts
+    return ["0", "0", "0", "0"]
 
 
-def _get_ip_address_first_if() -> list[str]:
-    """Returnerer første IP som liste [a,b,c,d] eller ['0','0','0','0']."""
+def _get_ip_address_first_if(gateway: list[str]) -> list[str]:
+    """IP-adressen mod gatewayen som [a,b,c,d], ellers ['0','0','0','0']."""
     try:
-        g = subprocess.check_output("hostname -I", shell=True).decode("utf-8").strip()
-        if not g:
-            g = "0.0.0.0"
-    except Exception as e:
-        print(f"⚠️ Failed to read IP address via hostname -I: {e}")
-        g = "0.0.0.0"
-    parts = g.split()
-    if not parts:
+        if gateway[0] != "0":
+            # connect() på en UDP-socket sender intet, men vælger kildeadressen mod gatewayen
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                sock.connect((".".join(gateway), 9))
+                ip = sock.getsockname()[0]
+        else:
+            ip = socket.gethostbyname(socket.gethostname())
+    except OSError:
         return ["0", "0", "0", "0"]
-    ip = parts[0].split(".")
-    if len(ip) != 4:
+    parts = ip.split(".")
+    if len(parts) != 4 or parts[0] in ("0", "127"):
         return ["0", "0", "0", "0"]
-    return ip
+    return parts
+
 
+# Netværksinfo i Modbus: IP 211–214, gateway 215–218, DNS 219–222, netstatus 466.
+# Registrene kan ikke læses tilbage (en FC06 echo-læsning her ville skrive 0), så de
+# sidst skrevne værdier huskes i network_pushed og gemmes i state snapshot'et.
+NETWORK_STATUS_REGISTER = 466
+NETWORK_CHECK_INTERVAL = float(os.getenv("NETWORK_CHECK_INTERVAL", "60"))
+NETWORK_REPUSH_INTERVAL = 24 * 3600.0  # write everything again once a day regardless
+network_pushed: dict = {}  # register -> value last written
+network_pushed_at = 0.0  # wall time of the last complete push
+
+def _boot_id() -> str:
+    """Changes on every Pi boot; a reboot often means the DVI lost power as well."""
+    try:
+        with open("/proc/sys/kernel/random/boot_id") as fh:
+            return fh.read().strip()
+    except OSError:
+        return ""
 
-def _push_network_config_to_modbus() -> None:
+def _network_registers() -> dict:
+    gw = _get_default_gateway_linux()
+    ip = _get_ip_address_first_if(gw)
+    dns = _get_default_dns_linux()
+    values = {}
+    for base, parts in ((211, ip), (215, gw), (219, dns)):
+        for i, part in enumerate(parts):
+            values[base + i] = int(part)
+    values[NETWORK_STATUS_REGISTER] = 1  # svarer til setNetOn i functions.py
+    return values
+
+def _push_network_config_to_modbus(force: bool = False) -> None:
     """
     Skriv IP, gateway og DNS til Modbus registre 211–222 samt netstatus til 466,
-    som i functions.py:setIP/setNetOn.
+    som i functions.py:setIP/setNetOn - men kun de registre der er ændret siden
+    sidst, med mindre force (reconnect, daglig genskrivning).
     """
-    ip = _get_ip_address_first_if()
-    gw = _get_default_gateway_linux()
-    dns = _get_default_dns_linux()
+    global network_pushed_at
+    if not transport.connected:
+        return  # on_transport_reconnect pushes everything once the port is back
+    values = _network_registers()
+    # The daily re-push only starts once the previous push is complete, else a
+    # failed register would make every check rewrite all of them again
+    due = time.time() - network_pushed_at >= NETWORK_REPUSH_INTERVAL
+    if force or (due and all(reg in network_pushed for reg in values)):
+        for reg in values:
+            network_pushed.pop(reg, None)  # forgotten until written, so failures are retried
+    changed = {reg: value for reg, value in values.items() if network_pushed.get(reg) != value}
+    if not changed:
+        return
+    complete = any(reg not in network_pushed for reg in changed)  # a full (re)push, not just a change
+
+    ip, gw, dns = ([str(values[base + i]) for i in range(4)] for base in (211, 215, 219))
+    print(f"ℹ️ Network info: IP={'.'.join(ip)}, GW={'.'.join(gw)}, DNS={'.'.join(dns)} "
+          f"({len(changed)} of {len(values)} registers to write)")
+    failed = 0
+    for reg, value in changed.items():
+        if write_fc06(reg, value):
+            network_pushed[reg] = value
+        else:
+            failed += 1
+    if failed:
+        print(f"❌ Failed to push {failed} network registers to Modbus, retrying in {NETWORK_CHECK_INTERVAL:.0f}s")
+        return
+    if complete:
+        network_pushed_at = time.time()
+    print("✅ Wrote IP/gateway/DNS and network status to Modbus (regs 211–222, 466)")
+    save_snapshot()  # so a restart right after this does not write them again
 
-    print(f"ℹ️ Network info: IP={'.'.join(ip)}, GW={'.'.join(gw)}, DNS={'.'.join(dns)}")
 
-    try:
-        # IP: 211–214
-        write_fc06(211, int(ip[0]))
-        write_fc06(212, int(ip[1]))
-        write_fc06(213, int(ip[2]))
-        write_fc06(214, int(ip[3]))
-
-        # Gateway: 215–218
-        write_fc06(215, int(gw[0]))
-        write_fc06(216, int(gw[1]))
-        write_fc06(217, int(gw[2]))
-        write_fc06(218, int(gw[3]))
-
-        # DNS: 219–222
-        write_fc06(219, int(dns[0]))
-        write_fc06(220, int(dns[1]))
-        write_fc06(221, int(dns[2]))
-        write_fc06(222, int(dns[3]))
-
-        print("✅ Wrote IP/gateway/DNS to Modbus (regs 211–222)")
-    except Exception as e:
-        print(f"❌ Failed to push network config to Modbus: {e}")
+# Persistent cache
+last_coils = {}
+last_inputs = {}
+last_writes = {}
+last_published = None
+state_lock = threading.RLock()  # poll thread and command read-backs share the caches
+
+# Freshness: every cached value carries (acquired at, read duration, register key).
+# A value counts as stale once it is older than STALE_AFTER_INTERVALS poll intervals.
+MEASUREMENT_TIMESTAMPS = os.getenv("MEASUREMENT_TIMESTAMPS", "0") == "1"
+STALE_AFTER_INTERVALS = 3
+acquired: dict = {}
+awaited: dict = {}  # key not read since startup -> (polled since, register key)
+stale_keys: set = set()
+restored_keys: set = set()  # loaded from the warm-start snapshot, stale until read again
+pipeline_latency = LatencyHistogram()  # serial read -> decode -> MQTT publish
+last_publish_check = 0.0
+
+def note_acquired(keys, started: Optional[float], reg_key: Optional[str] = None) -> None:
+    """Stamp freshly decoded values; started is time.monotonic() before the read."""
+    if started is None:
+        return
+    now = time.time()
+    read_seconds = time.monotonic() - started
+    for key in keys:
+        acquired[key] = (now, read_seconds, reg_key or key)
+        awaited.pop(key, None)
+        if key in restored_keys:
+            # First read after a warm start: fresh again without a recovery log line
+            restored_keys.discard(key)
+            stale_keys.discard(key)
+
+def await_values(units: list) -> None:
+    """Expect a value for every polled register, so one that never arrives goes stale too."""
+    now = time.time()
+    for _, _, _, _, regs in units:
+        for reg in regs:
+            if not reg.omit and reg.key not in acquired:
+                awaited.setdefault(reg.key, (now, reg.key))
+
+def check_staleness(now: float) -> None:
+    """Log values that stopped updating (or never arrived), and when they recover."""
+    for key, (since, reg_key) in list(awaited.items()):
+        interval = scheduler.interval(POLL_UNIT_OF.get(reg_key))
+        if key not in stale_keys and interval is not None and now - since > STALE_AFTER_INTERVALS * interval:
+            stale_keys.add(key)
+            print(f"⚠️ {key} is stale, not read since polling started {now - since:.0f}s ago")
+    for key, (at, _, reg_key) in list(acquired.items()):
+        interval = scheduler.interval(POLL_UNIT_OF.get(reg_key))
+        stale = key in restored_keys or (interval is not None and now - at > STALE_AFTER_INTERVALS * interval)
+        if stale and key in restored_keys:
+            stale_keys.add(key)  # expected after a restart, not worth a log line
+        elif stale and key not in stale_keys:
+            stale_keys.add(key)
+            print(f"⚠️ {key} is stale, last read {now - at:.0f}s ago")
+        elif not stale and key in stale_keys:
+            stale_keys.discard(key)
+            print(f"✅ {key} is updating again")
+
+def freshness_snapshot() -> dict:
+    now = time.time()
+    with state_lock:
+        return {
+            "pipeline_latency": pipeline_latency.snapshot(),
+            "age_s": {key: round(now - at, 1) for key, (at, _, _) in sorted(acquired.items())},
+            "read_ms": {key: round(1000 * read, 1) for key, (_, read, _) in sorted(acquired.items())},
+            "stale": sorted(stale_keys),
+        }
+
+
+def poll_coils() -> None:
+    global last_coils
+    started = time.monotonic()
+    coils = read_coils()
+    if not coils:
+        return  # failed or quarantined: keep the cached coils, they go stale on their own
+    last_coils = dict(sorted(coils.items()))
+    note_acquired(coils, started)
+    adapt_poll_intervals(last_coils)
+
+
+# Monotonic registers (EM23 energy is a total_increasing sensor): a lower
+# reading is only accepted after it has been seen this many times in a row
+# (meter reset/replacement).
+MONOTONIC_RESET_CONFIRMATIONS = 3
+monotonic_raw: dict = {}
+monotonic_drops: dict = {}
+
+def _accept_monotonic(reg, raw: int) -> bool:
+    last = monotonic_raw.get(reg.key)
+    if last is not None and raw < last:
+        drops = monotonic_drops.get(reg.key, 0) + 1
+        monotonic_drops[reg.key] = drops
+        if drops < MONOTONIC_RESET_CONFIRMATIONS:
+            print(f"⚠️ {reg.key} went backwards ({raw} < {last}), ignoring reading")
+            return False
+        print(f"ℹ️ {reg.key} stayed below {last} for {drops} reads, accepting meter reset")
+    monotonic_drops[reg.key] = 0
+    monotonic_raw[reg.key] = raw
+    return True
+
+
+def poll_input_span(start: int, count: int, regs: list) -> None:
+    """One contiguous FC04 span, decoded into last_inputs in one pass."""
+    started = time.monotonic()
+    values, block = read_input_range(start, count, addresses=sorted({a for reg in regs for a in reg.addresses}))
+    for reg in regs:
+        if reg.omit or any(addr not in values for addr in reg.addresses):
+            continue
+        raw = 0
+        for addr in reg.addresses:
+            raw = (raw << 16) | values[addr]
+        if reg.words > 1 and not block and read_input(reg.address) != values[reg.address]:
+            # Per-register fallback: the low word carried into the high word between the reads
+            print(f"⚠️ {reg.key} changed between word reads, skipping torn value")
+            continue
+        if reg.monotonic and not _accept_monotonic(reg, raw):
+            continue
+        last_inputs[reg.key] = reg.decode(raw)
+        note_acquired((reg.key,), started)
+
+
+def poll_setting(reg) -> None:
+    """One FC06 echo register, or both addresses of a dynamic curve point."""
+    started = time.monotonic()
+    if not reg.curve:
+        raw = read_via_fc06(reg.address)
+        if raw is not None:
+            store_setting(reg, raw, started)
+        return
+
+    # Curve addresses follow the cached central heating config
+    reg_info = resolve_curve_register(reg.curve)
+    if reg_info is None:
+        return
+    val = read_via_fc06(reg_info["write"])
+    if val is not None:
+        last_writes[f"{reg.key}_write"] = val
+        note_acquired((f"{reg.key}_write",), started, reg.key)
+    val = read_via_fc06(reg_info["read"])
+    if val is not None:
+        last_writes[f"{reg.key}_read"] = val
+        last_writes[reg.key] = val  # backwards compatibility
+        note_acquired((f"{reg.key}_read", reg.key), started, reg.key)
+
+
+# --- FC06 settings bank block reads -----------------------------------------
+# FC06 "reads" are writes of 0 that the controller echoes back, one register
+# per round trip. If the STM32 bridge answers a block read (FC03/FC04) over the
+# same addresses with the same values, those spans are read in one go instead.
+SETTINGS_BLOCK_PROBE = os.getenv("SETTINGS_BLOCK_PROBE", "1") != "0"
+SETTINGS_BLOCK_FUNCTIONS = (3, 4)
+SETTINGS_BLOCK_GAP = 12  # unused registers read through when joining spans
+settings_block_fc: Optional[int] = None
+settings_block_spans: list = []  # (start, count) verified against the echo
+settings_block_probed = False  # set once the probe ran without bus errors
+SETTINGS_PROBE_RETRY = 600.0  # seconds between probe attempts until one completes
+SETTINGS_PROBE_ATTEMPTS = 6  # incomplete probes before giving up on block reads
+settings_probe_attempts = 0
+settings_read_benchmark: dict = {}  # probe timings, published under settings_read on dvi/diagnostics/modbus
+
+def _settings_span_verified(start: int, count: int) -> bool:
+    return any(s <= start and start + count <= s + c for s, c in settings_block_spans)
+
+
+def probe_settings_block_read() -> None:
+    """
+    Read the FC06 settings via the echo (which also fills last_writes), then
+    try each span as a FC03/FC04 block read and keep the spans whose values
+    match the echo exactly. Prints the timing of both paths.
+
+    Single-register spans are left on the echo: a block read saves nothing
+    there, and an unimplemented address answering 0 would match a setting
+    that is 0. For the same reason a span where every value is 0 is not
+    accepted either.
+
+    Only an exception reply rules a function code out. A span whose block read
+    times out on every attempt while its echo reads answer (an address inside
+    it that never answers) is treated as not supported for that span. After
+    other timeouts or a damaged reply the probe stays incomplete and
+    retry_settings_probe() runs it again later, up to SETTINGS_PROBE_ATTEMPTS.
+    """
+    global settings_block_fc, settings_block_probed, settings_probe_attempts
+    regs = [reg for reg in REGISTERS if reg.function == FC_ECHO and not reg.curve]
+    spans = [(start, count) for start, count in block_ranges(regs, max_gap=SETTINGS_BLOCK_GAP)
+             if sum(start <= reg.address < start + count for reg in regs) > 1]
+    settings_read_benchmark.clear()
+
+    echo: dict = {}
+    echo_time = 0.0
+    echo_reads = 0
+    inconclusive = False
+    for functioncode in SETTINGS_BLOCK_FUNCTIONS:
+        verified = []
+        block_time = 0.0
+        block_reads = 0
+        for start, count in spans:
+            span = [reg for reg in regs if start <= reg.address < start + count]
+            answered = rejected = False
+            silent = 0  # block reads that failed while the echo of the span answered
+            for attempt in range(3):  # a live value may change between the reads, or a reply get lost
+                if attempt or any(reg.address not in echo for reg in span):
+                    t0 = time.monotonic()
+                    for reg in span:
+                        echo[reg.address] = read_via_fc06(reg.address)
+                        if echo[reg.address] is not None:
+                            store_setting(reg, echo[reg.address])
+                    echo_time += time.monotonic() - t0
+                    echo_reads += len(span)
+                if any(echo[reg.address] is None for reg in span):
+                    continue
+                t1 = time.monotonic()
+                try:
+                    block = read_registers_block(start, count, functioncode=functioncode, probe=True)
+                except SlaveReportedException:
+                    block = None
+                    rejected = True
+                block_time += time.monotonic() - t1
+                block_reads += 1
+                if rejected:
+                    break
+                if block is None:
+                    silent += 1
+                    continue
+                answered = True
+                if (all(echo[reg.address] == block[reg.address - start] for reg in span)
+                        and any(echo[reg.address] for reg in span)):
+                    verified.append((start, count))
+                    break
+            if silent == 3:
+                print(f"ℹ️ FC{functioncode:02d} block read of 0x{start:02X}-0x{start + count - 1:02X} never "
+                      "answered while the echo did, reading that span one register at a time")
+            inconclusive |= not (answered or rejected or silent == 3)
+            if rejected and not verified:
+                break  # function code not supported at all
+
+        if echo_reads and block_reads:
+            settings_read_benchmark["echo_ms_per_register"] = round(1000 * echo_time / echo_reads, 1)
+            settings_read_benchmark[f"fc{functioncode:02d}"] = {
+                "ms_per_read": round(1000 * block_time / block_reads, 1),
+                "spans": len(spans),
+                "verified_spans": [f"0x{s:02X}-0x{s + c - 1:02X}" for s, c in verified],
+            }
+            print(
+                f"📊 FC06 settings: echo {echo_reads} regs in {echo_time:.2f}s "
+                f"({1000 * echo_time / echo_reads:.0f} ms/reg), FC{functioncode:02d} block "
+                f"{block_reads} reads in {block_time:.2f}s, {len(verified)}/{len(spans)} spans match"
+            )
+        if verified:
+            settings_block_fc = functioncode
+            settings_block_spans[:] = verified
+            settings_block_probed = True
+            settings_read_benchmark["block_function"] = f"fc{functioncode:02d}"
+            print(f"✅ Reading FC06 settings with FC{functioncode:02d} block reads where verified")
+            return
+    if not transport.connected:
+        return  # a port lost mid-probe proves nothing, on_transport_reconnect retries it
+    settings_probe_attempts += 1
+    settings_block_probed = not inconclusive or settings_probe_attempts >= SETTINGS_PROBE_ATTEMPTS
+    if not inconclusive:
+        print("ℹ️ No block read matches the FC06 echo, reading settings one register at a time")
+    elif settings_block_probed:
+        print(f"⚠️ Settings block read probe still incomplete after {settings_probe_attempts} attempts, "
+              "giving up and reading settings one register at a time")
+    else:
+        print(f"⚠️ Settings block read probe incomplete (bus errors), retrying in {SETTINGS_PROBE_RETRY:.0f}s")
+
 
+def poll_setting_span(start: int, count: int, regs: list) -> None:
+    """A verified settings span in one block read, echo per register if it fails."""
+    started = time.monotonic()
     try:
-        # Netværksstatus: 466, værdi 1 (on), svarer til setNetOn i functions.py
-        write_fc06(466, 1)
-        print("✅ Set network status ON in Modbus (reg 466)")
-    except Exception as e:
-        print(f"❌ Failed to set network status in Modbus: {e}")
+        values = read_registers_block(start, count, functioncode=settings_block_fc)
+    except SlaveReportedException:
+        values = None
+    if values is None:
+        for reg in regs:
+            poll_setting(reg)
+        return
+    for reg in regs:
+        store_setting(reg, values[reg.address - start], started)
 
 
-# Timers and persistent cache
-last_coil_update = 0
-last_fc04_update = 0
-last_misc_update = 0
+# Optional interval overrides from .env, by poll class or register key, e.g.
+#   POLL_INTERVALS=fc04:5,fc06_counters:3600,cv_curve:900
+def _parse_poll_intervals(spec: str) -> dict:
+    overrides = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        try:
+            key, seconds = item.rsplit(":", 1)
+            overrides[key.strip()] = float(seconds)
+        except ValueError:
+            print(f"⚠️ Ignoring invalid POLL_INTERVALS entry '{item.strip()}'")
+    return overrides
 
-last_coils = {}
-last_inputs = {}
-last_writes = {}
-last_published = None
+POLL_INTERVAL_OVERRIDES = _parse_poll_intervals(os.getenv("POLL_INTERVALS", ""))
 
-# Start MQTT and push net config once at startup
-mqtt_client.connect(MQTT_HOST, MQTT_PORT, 60)
-mqtt_client.loop_start()
+def poll_interval(reg) -> float:
+    return POLL_INTERVAL_OVERRIDES.get(reg.key, POLL_INTERVAL_OVERRIDES.get(reg.poll, reg.poll_interval))
 
-# Skriv IP/gateway/DNS og netstatus til DVI via STM32 bridge ved opstart
-_push_network_config_to_modbus()
 
-while True:
-    now = time.time()
+FC04_BLOCK_GAP = 3  # omitted FC04 registers read through inside a block
+# Poll the omitted FC04 registers too, like the original bridge did (benchmark_bridge.py --mode legacy)
+POLL_OMITTED_INPUTS = os.getenv("POLL_OMITTED_INPUTS", "0") == "1"
 
-    # Coils every 13s
-    if now - last_coil_update >= 13:
-        coils = read_coils()
-        last_coils = dict(sorted(coils.items()))
-        last_coil_update = now
-
-    # FC04 sensors every 17s
-    if now - last_fc04_update >= 17:
-        fc04_raw = {}
-        for reg in range(0x01, 0x0F):
-            val = read_input(reg, signed=True)
-            if val is not None:
-                fc04_raw[f"sensor_{reg}"] = val
-
-        for key, raw in fc04_raw.items():
-            if key in omit_fc04:
+def _build_poll_units() -> list:
+    """
+    Split the register map into independently scheduled reads: the coil
+    block, one FC04 block per contiguous span sharing interval and priority,
+    and one FC06 echo per setting. Returns [(name, interval, priority, func, regs)].
+    """
+    units = [(
+        "coils",
+        min(poll_interval(reg) for reg in COILS),
+        min(reg.poll_priority for reg in COILS),
+        poll_coils,
+        COILS,
+    )]
+
+    # Omitted (unlabelled) sensors are never requested on their own; a block
+    # read may still span them when that saves transactions.
+    groups: dict = {}
+    for reg in REGISTERS:
+        if reg.function == FC_INPUT and (POLL_OMITTED_INPUTS or not reg.omit):
+            groups.setdefault((reg.poll, poll_interval(reg), reg.poll_priority), []).append(reg)
+    for (poll, interval, priority), regs in groups.items():
+        for start, count in block_ranges(regs, max_gap=FC04_BLOCK_GAP):
+            span = [reg for reg in regs if start <= reg.address < start + count]
+            func = functools.partial(poll_input_span, start, count, span)
+            units.append((f"{poll}@0x{start:02X}", interval, priority, func, span))
+
+    # FC06 settings: block spans verified by probe_settings_block_read(),
+    # the FC06 echo per register for everything else
+    groups = {}
+    for reg in REGISTERS:
+        if reg.function != FC_ECHO:
+            continue
+        if reg.curve or settings_block_fc is None:
+            func = functools.partial(poll_setting, reg)
+            units.append((reg.key, poll_interval(reg), reg.poll_priority, func, [reg]))
+        else:
+            groups.setdefault((reg.poll, poll_interval(reg), reg.poll_priority), []).append(reg)
+    for (poll, interval, priority), regs in groups.items():
+        for start, count in block_ranges(regs, max_gap=SETTINGS_BLOCK_GAP):
+            span = [reg for reg in regs if start <= reg.address < start + count]
+            if _settings_span_verified(start, count):
+                func = functools.partial(poll_setting_span, start, count, span)
+                units.append((f"{poll}@0x{start:02X}", interval, priority, func, span))
                 continue
-            label = fc04_labels.get(key, key)
-            last_inputs[label] = round(raw * 0.1, 1)
-
-        # EM23 power (FC04)
-        power = read_input(0x24)
-        if power is not None:
-            last_inputs["em23_power"] = round(power * 0.0001, 4)
-
-        last_fc04_update = now
-
-    # EM23 energy + curve temp + FC06 reads every 60s
-    if now - last_misc_update >= 60:
-        msw = read_input(0x25)
-        lsw = read_input(0x26)
-        if msw is not None and lsw is not None:
-            raw_energy = (msw << 16) + lsw
-            last_inputs["em23_energy"] = round(raw_energy * 0.1, 1)
-
-        # Base FC06 set (no static curve_set entries)
-        fc06_regs_60s = {
-            0x01: "cv_mode",
-            0x02: "cv_curve",
-            0x03: "cv_setpoint",
-            0x04: "cv_night",
-            0x0A: "vv_mode",
-            0x0B: "vv_setpoint",
-            0x0C: "vv_schedule",
-            0x0F: "aux_heating",
-            0xA1: "comp_hours",
-            0xA2: "vv_hours",
-            0xA3: "heating_hours",
-            0xD0: "curve_temp",
-            0x1A: "central_heating_config",
-            0x1B: "cv_max",
-            0x1C: "cv_min",
-            0x8D: "outdoor_cal"
-        }
+            for reg in span:
+                func = functools.partial(poll_setting, reg)
+                units.append((reg.key, interval, priority, func, [reg]))
+    return units
 
-        # Define adjustments: reg -> (multiplier, decimals)
-        fc06_adjustments = {
-            0xD0: (0.1, 1),   # curve_temp
-            0x8D: (0.1, 1)    # outdoor_cal
-        }
+# Filled in by schedule_poll_units() once the settings block probe has run
+POLL_UNITS: list = []
+POLL_UNIT_OF: dict = {}
 
-        # Define which FC06 registers are signed
-        signed_fc06 = {0x8D}  # outdoor_cal
-        
-        # Read base FC06 set
-        for reg, label in fc06_regs_60s.items():
-            val = read_via_fc06(reg, signed=(reg in signed_fc06))
-            if val is not None:
-                if reg in fc06_adjustments:
-                    mult, decimals = fc06_adjustments[reg]
-                    last_writes[label] = round(val * mult, decimals)
-                else:
-                    last_writes[label] = val
-
-        # Use numeric config value to decide curve_set registers
-        config_val = last_writes.get("central_heating_config")
-        if isinstance(config_val, int):
-            curve_maps = {
-                0: {
-                    "write": {"12": 0x12F, "-12": 0x130},
-                    "read": {"12": 0x2F, "-12": 0x30},
-                },
-                1: {
-                    "write": {"12": 0x131, "-12": 0x132},
-                    "read": {"12": 0x31, "-12": 0x32},
-                },
-                2: {
-                    "write": {"12": 0x133, "-12": 0x134},
-                    "read": {"12": 0x33, "-12": 0x34},
-                },
-            }
-            curve_cfg = curve_maps.get(config_val)
-            if curve_cfg:
-                for key, reg in curve_cfg["write"].items():
-                    val = read_via_fc06(reg)
-                    if val is not None:
-                        last_writes[f"curve_set_{key}_write"] = val
-                for key, reg in curve_cfg["read"].items():
-                    val = read_via_fc06(reg)
-                    if val is not None:
-                        read_key = f"curve_set_{key}_read"
-                        last_writes[read_key] = val
-                        last_writes[f"curve_set_{key}"] = val  # backwards compatibility
-
-        last_misc_update = now
+
+def schedule_poll_units() -> None:
+    """
+    Everything is read once at startup (in priority order); after that, units
+    sharing an interval are phase-shifted across it instead of bursting together.
+    """
+    POLL_UNITS[:] = _build_poll_units()
+    POLL_UNIT_OF.clear()
+    POLL_UNIT_OF.update({reg.key: name for name, _, _, _, regs in POLL_UNITS for reg in regs})
+    await_values(POLL_UNITS)
+    by_interval: dict = {}
+    for unit in POLL_UNITS:
+        by_interval.setdefault(unit[1], []).append(unit)
+    for interval, units in by_interval.items():
+        for i, (name, _, priority, func, _) in enumerate(units):
+            task = functools.partial(run_poll_unit, priority, func)
+            scheduler.add(name, interval, task, priority=priority, phase=interval * i / len(units))
+
+def run_poll_unit(priority: int, func) -> None:
+    """While the port is gone, polls only run when a reconnect attempt is due."""
+    if transport.waiting():
+        return
+    bus.run_at(priority, func)
+
+def retry_settings_probe() -> None:
+    """
+    The probe has not completed (port missing at startup, or bus errors):
+    probe again and swap in the block-read poll units.
+    """
+    global heatpump_active
+    if settings_block_probed or not transport.connected:
+        return
+    probe_settings_block_read()
+    if settings_block_fc is None:
+        return
+    for name, *_ in POLL_UNITS:
+        scheduler.remove(name)
+    schedule_poll_units()
+    heatpump_active = None  # re-apply the adaptive intervals to the new units
+
+def on_transport_reconnect(seconds_down: float) -> None:
+    """
+    Called by the transport once the port is back, on whichever thread noticed
+    (the bus thread, or the main thread via the "reconnect" task), so it only
+    queues work. A USB reset or brown-out may come with a firmware update or a
+    DVI that lost the network info, so re-read the identity, push the network
+    config again and poll everything right away.
+    """
+    bus.submit(PRIORITY_SLOW, refresh_static_values_task)
+    bus.submit(PRIORITY_NORMAL, _push_network_config_to_modbus, True)
+    if SETTINGS_BLOCK_PROBE and not settings_block_probed:
+        bus.submit(PRIORITY_NORMAL, retry_settings_probe)
+    for name, *_ in POLL_UNITS:
+        scheduler.trigger(name)
+
+transport.on_reconnect = on_transport_reconnect
+RECONNECT_CHECK_INTERVAL = 2.0
+
+
+# Adaptive polling: FC04 temperatures and EM23 follow the operating state
+# decoded from the coils (fast while compressor/defrost/VV run, slow when idle).
+ADAPTIVE_POLLING = os.getenv("ADAPTIVE_POLLING", "1") != "0"
+heatpump_active: Optional[bool] = None
+
+def adapt_poll_intervals(coils: dict) -> None:
+    global heatpump_active
+    if not ADAPTIVE_POLLING or not coils:
+        return
+    active = any(coils.get(label) for label in ACTIVE_COILS)
+    if active == heatpump_active:
+        return
+    heatpump_active = active
+
+    changed = []
+    for name, _, _, _, regs in POLL_UNITS:
+        poll = regs[0].poll
+        if poll not in ADAPTIVE_INTERVALS or poll in POLL_INTERVAL_OVERRIDES:
+            continue
+        if any(reg.key in POLL_INTERVAL_OVERRIDES for reg in regs):
+            continue  # explicitly configured intervals win
+        active_interval, idle_interval = ADAPTIVE_INTERVALS[poll]
+        interval = active_interval if active else idle_interval
+        scheduler.set_interval(name, interval)
+        changed.append(f"{name}={interval}s")
+    if changed:
+        print(f"ℹ️ Heatpump {'active' if active else 'idle'}, poll intervals: {', '.join(changed)}")
+
+
+def read_back(reg, value_raw: int, received: float) -> None:
+    """
+    Re-read only the written register (and the ones its value affects) right
+    after a command write and publish at once, instead of waiting for the
+    next settings poll. Runs on the bus thread.
+    """
+    # The echo reads are serialized by the bus; the lock is only for the
+    # publish, so a /metrics scrape never waits on the serial port.
+    for key in (reg.key,) + reg.affects:
+        poll_setting(REGISTERS_BY_KEY[key])
+    with state_lock:
+        publish_measurement()
+        state = last_writes.get(reg.state_key or reg.key)
+
+    latency = time.monotonic() - received
+    confirmed = state == reg.decode(value_raw)
+    with pending_lock:
+        command_stats["confirmed" if confirmed else "mismatched"] += 1
+        command_stats["latency_total"] += latency
+        command_stats["latency_max"] = max(command_stats["latency_max"], latency)
+    if confirmed:
+        print(f"✅ {reg.key} confirmed at {state} {1000 * latency:.0f}ms after the command")
+    else:
+        print(f"⚠️ {reg.key} read back {state} after writing {value_raw}")
+
+
+def publish_measurement() -> None:
+    """Publish the cached values on dvi/measurement if anything changed."""
+    with state_lock:
+        _publish_measurement()
+
+def _publish_measurement() -> None:
+    global last_published, last_publish_check
 
     # Final payload from cached values
     full_payload = {
@@ -959,9 +1772,260 @@ while True:
             "yy": SERVICE_YY,
         }
 
+    now = time.time()
+    check_staleness(now)
+    if MEASUREMENT_TIMESTAMPS:
+        full_payload["acquired"] = {key: round(at, 1) for key, (at, _, _) in sorted(acquired.items())}
+        full_payload["stale"] = sorted(stale_keys)
+
     # Only publish if payload changed
     if full_payload != last_published:
         mqtt_client.publish("dvi/measurement", json.dumps(full_payload))
         last_published = full_payload
+        published = time.time()
+        for at, _, _ in list(acquired.values()):
+            if at > last_publish_check:
+                pipeline_latency.add(1000 * (published - at), False)
+    last_publish_check = now
+
+
+# --- Warm-start snapshot ---
+# The value caches are written to disk every SNAPSHOT_INTERVAL seconds so a
+# restart can publish a complete (stale-marked) payload straight away and
+# refresh it in priority order, instead of waiting for every poll class.
+SNAPSHOT_PATH = os.getenv("STATE_SNAPSHOT", os.path.join(SCRIPT_DIR, "state.json"))
+SNAPSHOT_INTERVAL = 60.0
+SNAPSHOT_MAX_AGE = 24 * 3600.0
+
+def save_snapshot() -> None:
+    with state_lock:
+        snapshot = {
+            "saved_at": time.time(),
+            "coils": dict(last_coils),
+            "input_registers": dict(last_inputs),
+            "write_registers": dict(last_writes),
+            "acquired": {key: at for key, (at, _, _) in acquired.items()},
+            "monotonic_raw": dict(monotonic_raw),
+            "network": {"boot_id": _boot_id(), "pushed_at": network_pushed_at,
+                        "registers": dict(network_pushed)},
+            "static_refreshed_at": static_refreshed_at,
+        }
+    tmp_path = f"{SNAPSHOT_PATH}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, SNAPSHOT_PATH)  # atomic: never leave a half-written snapshot
+    except OSError as e:
+        print(f"⚠️ Could not write state snapshot {SNAPSHOT_PATH}: {e}")
+
+def load_snapshot() -> bool:
+    """Fill the caches from the last snapshot, every value marked stale."""
+    global last_coils, network_pushed_at, static_refreshed_at
+    try:
+        with open(SNAPSHOT_PATH, "r", encoding="utf-8") as f:
+            snapshot = json.load(f)
+        age = time.time() - snapshot["saved_at"]
+    except FileNotFoundError:
+        return False
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"⚠️ Ignoring unreadable state snapshot {SNAPSHOT_PATH}: {e}")
+        return False
+    if age > SNAPSHOT_MAX_AGE:
+        print(f"ℹ️ State snapshot is {age / 3600:.0f}h old, not using it")
+        return False
+
+    with state_lock:
+        last_coils = dict(snapshot.get("coils", {}))
+        last_inputs.update(snapshot.get("input_registers", {}))
+        last_writes.update(snapshot.get("write_registers", {}))
+        monotonic_raw.update(snapshot.get("monotonic_raw", {}))
+        static_refreshed_at = snapshot.get("static_refreshed_at", 0.0)
+        network = snapshot.get("network", {})
+        if network.get("boot_id") == _boot_id():  # same boot: the DVI still has what we wrote
+            network_pushed.update({int(reg): value for reg, value in network.get("registers", {}).items()})
+            network_pushed_at = network.get("pushed_at", 0.0)
+        saved_at = snapshot["saved_at"]
+        for key in (*last_coils, *last_inputs, *last_writes):
+            reg = REGISTERS_BY_KEY.get(key)
+            base = key if reg else key.rsplit("_", 1)[0]  # curve_set_12_read -> curve_set_12
+            acquired[key] = (snapshot.get("acquired", {}).get(key, saved_at), 0.0, base)
+            restored_keys.add(key)
+    if not restored_keys:
+        return False
+    print(f"♻️ Restored {len(restored_keys)} values from state snapshot ({age:.0f}s old), refreshing")
+    return True
+
+
+# --- Diagnostics ---
+DIAGNOSTICS_INTERVAL = float(os.getenv("DIAGNOSTICS_INTERVAL", "300"))
+
+def publish_diagnostics() -> None:
+    """Log and publish the transaction, bus and command statistics."""
+    print(f"📈 Modbus: {modbus_stats.summary()}")
+    timeouts = serial_timeout.snapshot()
+    if ADAPTIVE_TIMEOUT:
+        print(f"⏲️ Serial timeouts: {', '.join(f'{fc} {t * 1000:.0f}ms' for fc, t in timeouts.items())}")
+    bus_snapshot = bus.report()
+    command_snapshot = report_commands()
+    link = transport.snapshot()
+    if link["disconnects"]:
+        recovery = f"last recovery {link['last_recovery_s']}s, " if link["last_recovery_s"] is not None else ""
+        print(f"🔌 Link: {link['disconnects']} disconnects, {link['reconnects']} reconnects, "
+              f"{recovery}{link['downtime_s']}s down in total")
+    mqtt_client.publish("dvi/diagnostics/modbus",
+                        json.dumps({**modbus_stats.snapshot(), "timeouts_s": timeouts, "link": link,
+                                    "settings_read": settings_read_benchmark}))
+    mqtt_client.publish("dvi/diagnostics/bus", json.dumps(bus_snapshot))
+    mqtt_client.publish("dvi/diagnostics/commands", json.dumps(command_snapshot))
+    health = register_health.snapshot()
+    unhealthy = [f"{key} ({reg['state']})" for key, reg in health["registers"].items()]
+    if unhealthy:
+        print(f"🚧 Register health: {', '.join(unhealthy)}; {health['skipped_reads']} reads skipped")
+    mqtt_client.publish("dvi/diagnostics/registers", json.dumps(health))
+    freshness = freshness_snapshot()
+    print(f"🕒 Freshness: read to publish avg {freshness['pipeline_latency']['avg_ms']}ms "
+          f"max {freshness['pipeline_latency']['max_ms']}ms, stale: {', '.join(freshness['stale']) or 'none'}")
+    mqtt_client.publish("dvi/diagnostics/freshness", json.dumps(freshness))
+
+
+# --- Prometheus /metrics endpoint ---
+METRICS_PORT = os.getenv("METRICS_PORT", "").strip()
+METRICS_BIND = os.getenv("METRICS_BIND", "")
+
+def _gauge_samples(label: str, values: dict) -> list:
+    return [({label: key}, float(val)) for key, val in values.items() if isinstance(val, (int, float))]
+
+def collect_metrics() -> str:
+    """Render the cached values and bridge internals. Never touches the bus."""
+    with state_lock:
+        coils = dict(last_coils)
+        inputs = dict(last_inputs)
+        writes = dict(last_writes)
+    stats = modbus_stats.snapshot()
+    bus_depth = bus.depth()
+
+    latency = []
+    for fc, hist in stats["function_codes"].items():
+        cumulative = 0
+        for bucket, count in hist["histogram"].items():
+            cumulative += count
+            le = "+Inf" if bucket == "inf" else str(int(bucket[3:]) / 1000)
+            latency.append(("_bucket", {"function": fc, "le": le}, cumulative))
+        latency.append(("_sum", {"function": fc}, hist["total_ms"] / 1000))
+        latency.append(("_count", {"function": fc}, hist["count"]))
+
+    families = [
+        ("dvi_coil", "gauge", "Coil state (1 = on)", _gauge_samples("name", coils)),
+        ("dvi_input_register", "gauge", "Decoded FC04 input register", _gauge_samples("key", inputs)),
+        ("dvi_setting", "gauge", "Decoded FC06 setting", _gauge_samples("key", writes)),
+        ("dvi_modbus_transaction_seconds", "histogram", "Modbus transaction latency", latency),
+        ("dvi_modbus_transactions_total", "counter", "Modbus transactions",
+         [({}, stats["transactions"])]),
+        ("dvi_modbus_errors_total", "counter", "Failed Modbus transactions by kind",
+         [({"kind": kind}, n) for kind, n in stats["errors"].items()]),
+        ("dvi_modbus_register_errors_total", "counter", "Failed Modbus transactions by register",
+         [({"register": key}, reg["errors"]) for key, reg in stats["registers"].items()]),
+        ("dvi_modbus_bytes_total", "counter", "Bytes on the serial line",
+         [({"direction": "tx"}, stats["bytes_tx"]), ({"direction": "rx"}, stats["bytes_rx"])]),
+        ("dvi_modbus_timeout_seconds", "gauge", "Current serial reply timeout per function code",
+         [({"function": fc}, t) for fc, t in serial_timeout.snapshot().items()]),
+        ("dvi_register_quarantined", "gauge", "1 while a register is skipped after repeated failures",
+         [({"register": key}, int(reg["state"] == "quarantined"))
+          for key, reg in register_health.snapshot()["registers"].items()]),
+        ("dvi_register_skipped_reads_total", "counter", "Reads skipped because the register was quarantined",
+         [({}, register_health.skipped)]),
+        ("dvi_modbus_bus_queue_depth", "gauge", "Modbus jobs waiting for the bus", [({}, bus_depth)]),
+        ("dvi_poll_cycle_seconds", "gauge", "Wall time of the last poll cycle",
+         [({}, round(scheduler.last_cycle_wall, 4))]),
+        ("dvi_poll_cycles_total", "counter", "Poll cycles run", [({}, scheduler.cycles)]),
+        ("dvi_poll_unit_seconds", "gauge", "Wall time of the last read of a poll unit",
+         [({"unit": name, "poll": regs[0].poll}, round(scheduler.last_duration(name) or 0.0, 4))
+          for name, _, _, _, regs in POLL_UNITS]),
+        ("dvi_mqtt_published_messages_total", "counter", "MQTT messages published",
+         [({}, mqtt_stats["messages"])]),
+        ("dvi_mqtt_published_bytes_total", "counter", "MQTT payload bytes published",
+         [({}, mqtt_stats["bytes"])]),
+    ]
+    link = transport.snapshot()
+    families += [
+        ("dvi_transport_connected", "gauge", "1 while the heatpump interface is open",
+         [({"transport": link["transport"]}, int(link["connected"]))]),
+        ("dvi_transport_disconnects_total", "counter", "Times the heatpump interface was lost",
+         [({}, link["disconnects"])]),
+        ("dvi_transport_reconnects_total", "counter", "Times the heatpump interface was reopened",
+         [({}, link["reconnects"])]),
+        ("dvi_transport_downtime_seconds_total", "counter", "Time spent without the heatpump interface",
+         [({}, link["downtime_s"])]),
+        ("dvi_discovery_messages_total", "counter", "Home Assistant discovery configs published or skipped as unchanged",
+         [({"result": "published"}, discovery_stats["published"]),
+          ({"result": "skipped"}, discovery_stats["skipped"])]),
+    ]
+    if link["last_recovery_s"] is not None:
+        families.append(("dvi_transport_last_recovery_seconds", "gauge",
+                         "Seconds from losing the heatpump interface to reopening it",
+                         [({}, link["last_recovery_s"])]))
+    if modbus_stats.last_success is not None:
+        families.append(("dvi_modbus_seconds_since_success", "gauge",
+                         "Seconds since the last successful Modbus transaction",
+                         [({}, round(time.time() - modbus_stats.last_success, 1))]))
+    return format_metrics(families)
+
+def start_metrics_server() -> None:
+    if not METRICS_PORT:
+        return
+    try:
+        serve_metrics(int(METRICS_PORT), collect_metrics, METRICS_BIND)
+        print(f"📈 Serving Prometheus metrics on :{METRICS_PORT}/metrics")
+    except (OSError, ValueError) as e:
+        print(f"⚠️ Could not start metrics endpoint on port {METRICS_PORT}: {e}")
+
+
+# The snapshot also says when the static identity was last read
+restored = load_snapshot()
 
-    time.sleep(1)
\ No newline at end of file
+# Static identity first: discovery and the payload carry FABNR and the SW version
+if transport.connected and static_values_stale():
+    refresh_static_values()
+_log_static_values()
+
+# Start MQTT and push net config once at startup
+mqtt_client.connect(MQTT_HOST, MQTT_PORT, 60)
+mqtt_client.loop_start()
+start_metrics_server()
+
+# Publish the last known state right away, marked stale until it is re-read
+if restored:
+    publish_measurement()
+
+# Skriv IP/gateway/DNS og netstatus til DVI via STM32 bridge ved opstart
+# (uden port sker det først ved reconnect, se on_transport_reconnect)
+if transport.connected:
+    _push_network_config_to_modbus()
+
+if SETTINGS_BLOCK_PROBE and transport.connected:
+    probe_settings_block_read()
+schedule_poll_units()
+scheduler.add("diagnostics", DIAGNOSTICS_INTERVAL, publish_diagnostics, delay=DIAGNOSTICS_INTERVAL)
+scheduler.add("snapshot", SNAPSHOT_INTERVAL, save_snapshot, delay=SNAPSHOT_INTERVAL)
+scheduler.add("static_values", STATIC_REFRESH_INTERVAL, refresh_static_values_task,
+              delay=STATIC_REFRESH_INTERVAL, priority=PRIORITY_SLOW)
+# Re-push the network info when DHCP hands out a new address (only changed registers)
+scheduler.add("network", NETWORK_CHECK_INTERVAL,
+              functools.partial(bus.run_at, PRIORITY_SLOW, _push_network_config_to_modbus),
+              delay=NETWORK_CHECK_INTERVAL, priority=PRIORITY_SLOW)
+if SETTINGS_BLOCK_PROBE:
+    # Until the settings block read probe has completed (a no-op afterwards)
+    scheduler.add("settings_probe", SETTINGS_PROBE_RETRY,
+                  functools.partial(bus.run_at, PRIORITY_SLOW, retry_settings_probe),
+                  delay=SETTINGS_PROBE_RETRY, priority=PRIORITY_SLOW)
+# Watch for a lost port coming back (a no-op while connected)
+scheduler.add("reconnect", RECONNECT_CHECK_INTERVAL, transport.reconnect, delay=RECONNECT_CHECK_INTERVAL)
+
+def _on_sigterm(signum, frame) -> None:
+    raise SystemExit(0)  # systemd stop: unwind so the snapshot below is written
+
+signal.signal(signal.SIGTERM, _on_sigterm)
+try:
+    scheduler.run_forever(after_cycle=publish_measurement)
+finally:
+    save_snapshot()  # a restart picks up the latest values and network state, not the last 60s tick
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory Modbus transaction statistics.
+
+bridge.py times every serial transaction through ModbusStats.timed() and
+counts the bytes on the wire; the aggregated snapshot is published on
+dvi/diagnostics/... so poll intervals and timeouts can be tuned on the
+9600 baud link with real numbers.
+"""
+
+import bisect
+import struct
+import threading
+import time
+
+from transport import (ChecksumError, InvalidResponseError, NoResponseError,
+                       SlaveReportedException)
+
+# Upper bounds (ms) of the latency histogram buckets, the last bucket is open
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2000)
+
+ERROR_KINDS = ("timeout", "crc", "malformed", "exception", "serial", "other")
+
+
+def classify_error(exc: Exception) -> str:
+    """Map a transport.py exception onto one of ERROR_KINDS."""
+    if isinstance(exc, (NoResponseError, TimeoutError)):
+        return "timeout"
+    if isinstance(exc, ChecksumError):
+        return "crc"
+    if isinstance(exc, SlaveReportedException):
+        return "exception"
+    if isinstance(exc, (InvalidResponseError, struct.error)):
+        return "malformed"
+    if isinstance(exc, OSError):  # port errors, DisconnectedError
+        return "serial"
+    return "other"
+
+
+class LatencyHistogram:
+    __slots__ = ("count", "errors", "total", "max", "buckets")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def add(self, ms: float, failed: bool) -> None:
+        self.count += 1
+        self.errors += failed
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+
+    def snapshot(self) -> dict:
+        labels = [f"le_{b}" for b in LATENCY_BUCKETS_MS] + ["inf"]
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "avg_ms": round(self.total / self.count, 1) if self.count else 0.0,
+            "total_ms": round(self.total, 1),
+            "max_ms": round(self.max, 1),
+            "histogram": dict(zip(labels, self.buckets)),
+        }
+
+
+class ModbusStats:
+    """Latency histograms per function code and register, error and byte counters."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.by_function = {}  # "fc04" -> LatencyHistogram
+        self.by_register = {}  # "fc04@0x01" -> LatencyHistogram
+        self.errors = dict.fromkeys(ERROR_KINDS, 0)
+        self.bytes_tx = 0
+        self.bytes_rx = 0
+        self.last_success = None  # wall clock time of the last transaction that succeeded
+
+    def record(self, functioncode: int, register: int, seconds: float, error: Exception = None) -> None:
+        ms = seconds * 1000
+        fc = f"fc{functioncode:02d}"
+        key = f"{fc}@0x{register:02X}"
+        with self._lock:
+            for table, name in ((self.by_function, fc), (self.by_register, key)):
+                hist = table.get(name)
+                if hist is None:
+                    hist = table[name] = LatencyHistogram()
+                hist.add(ms, error is not None)
+            if error is not None:
+                self.errors[classify_error(error)] += 1
+            else:
+                self.last_success = time.time()
+
+    def count_bytes(self, sent: int, received: int) -> None:
+        with self._lock:
+            self.bytes_tx += sent
+            self.bytes_rx += received
+
+    def timed(self, functioncode: int, register: int, func, *args):
+        """Run one transaction and record its latency and outcome."""
+        start = time.perf_counter()
+        try:
+            result = func(*args)
+        except Exception as e:
+            self.record(functioncode, register, time.perf_counter() - start, e)
+            raise
+        self.record(functioncode, register, time.perf_counter() - start)
+        return result
+
+    def snapshot(self) -> dict:
+        """Counters since start, ready for json.dumps."""
+        with self._lock:
+            return {
+                "since": int(self.started),
+                "transactions": sum(h.count for h in self.by_function.values()),
+                "errors": dict(self.errors),
+                "bytes_tx": self.bytes_tx,
+                "bytes_rx": self.bytes_rx,
+                "last_success": self.last_success and int(self.last_success),
+                "function_codes": {k: h.snapshot() for k, h in sorted(self.by_function.items())},
+                "registers": {k: h.snapshot() for k, h in sorted(self.by_register.items())},
+            }
+
+    def summary(self) -> str:
+        """One log line: per function code count, average and max latency."""
+        with self._lock:
+            parts = [
+                f"{fc} {h.count}x avg {h.total / h.count:.0f}ms max {h.max:.0f}ms"
+                for fc, h in sorted(self.by_function.items()) if h.count
+            ]
+            errors = ", ".join(f"{k} {v}" for k, v in self.errors.items() if v) or "none"
+            return (f"{', '.join(parts) or 'no transactions'}; errors: {errors}; "
+                    f"{self.bytes_tx} bytes sent, {self.bytes_rx} received")
+
+
+class RegisterHealth:
+    """
+    Per-register failure tracking. A register that fails QUARANTINE_AFTER
+    times in a row while the rest of the bus answers is quarantined: it is
+    skipped for BACKOFF_START seconds, doubling up to BACKOFF_MAX after every
+    failed re-probe, and released by the first read that succeeds.
+
+    A block read is tracked under its own key (start and count), separate from
+    the single read of its first register: a dead register inside the span
+    quarantines the block, not the register that happens to start it.
+    """
+
+    QUARANTINE_AFTER = 3
+    BACKOFF_START = 60.0
+    BACKOFF_MAX = 3600.0
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._state = {}  # "fc04@0x05" -> dict
+        self._last_success_any = None
+        self.skipped = 0
+
+    @staticmethod
+    def key(functioncode: int, register: int, count: int = 1) -> str:
+        """'fc04@0x05' for a single register, 'fc04@0x01+12' for a block read of 12."""
+        key = f"fc{functioncode:02d}@0x{register:02X}"
+        return f"{key}+{count}" if count > 1 else key
+
+    def skip(self, functioncode: int, register: int, count: int = 1) -> bool:
+        """True while the register is quarantined; lets one re-probe through when the backoff ends."""
+        with self._lock:
+            state = self._state.get(self.key(functioncode, register, count))
+            if state is None or state["until"] is None:
+                return False
+            if time.monotonic() < state["until"]:
+                self.skipped += 1
+                return True
+            return False  # re-probe
+
+    def succeeded(self, functioncode: int, register: int, count: int = 1) -> str:
+        """Returns the key if this success released a quarantine, else ''."""
+        now = time.monotonic()
+        key = self.key(functioncode, register, count)
+        with self._lock:
+            self._last_success_any = now
+            state = self._state.pop(key, None)
+        return key if state and state["until"] is not None else ""
+
+    def failed(self, functioncode: int, register: int, count: int = 1) -> float:
+        """Count a failure; returns the backoff in seconds if the register is (re)quarantined, else 0."""
+        now = time.monotonic()
+        key = self.key(functioncode, register, count)
+        with self._lock:
+            state = self._state.setdefault(key, {"failures": 0, "last_failure": None,
+                                                 "until": None, "backoff": 0.0, "quarantines": 0})
+            # Only count it against the register if the bus answered something since
+            # its last failure; a dead link must not quarantine the whole map.
+            since = state["last_failure"]
+            bus_alive = self._last_success_any is not None and (since is None or self._last_success_any > since)
+            state["last_failure"] = now
+            if not bus_alive:
+                return 0.0
+            state["failures"] += 1
+            if state["until"] is None and state["failures"] < self.QUARANTINE_AFTER:
+                return 0.0
+            backoff = self.BACKOFF_START if state["until"] is None else min(state["backoff"] * 2, self.BACKOFF_MAX)
+            state.update(until=now + backoff, backoff=backoff, quarantines=state["quarantines"] + 1)
+            return backoff
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            registers = {
+                key: {
+                    "state": "quarantined" if s["until"] is not None else "failing",
+                    "failures": s["failures"],
+                    "quarantines": s["quarantines"],
+                    "retry_in_s": round(max(0.0, s["until"] - now), 1) if s["until"] is not None else None,
+                }
+                for key, s in sorted(self._state.items())
+            }
+            return {"skipped_reads": self.skipped, "registers": registers}
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Optional Prometheus-style /metrics endpoint (stdlib only).
+
+bridge.py passes a collect() callback that renders the cached values and
+bridge internals from memory; a scrape never touches the serial port.
+"""
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_metrics(families) -> str:
+    """
+    families: iterable of (name, type, help, samples) where samples is a list
+    of (labels dict, value) or (suffix, labels dict, value) for histograms.
+    """
+    lines = []
+    for name, kind, help_text, samples in families:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for sample in samples:
+            suffix, labels, value = sample if len(sample) == 3 else ("", *sample)
+            if isinstance(value, bool):
+                value = int(value)
+            if labels:
+                label_str = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+                lines.append(f"{name}{suffix}{{{label_str}}} {value}")
+            else:
+                lines.append(f"{name}{suffix} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        try:
+            body = self.server.collect().encode("utf-8")
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes every few seconds would flood the journal
+
+
+def serve_metrics(port: int, collect, host: str = "") -> ThreadingHTTPServer:
+    """Serve collect() on http://host:port/metrics from a daemon thread."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    server.collect = collect
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
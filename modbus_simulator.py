@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+"""
+DVI LV heat pump simulator (Modbus RTU slave 0x10) on a pseudo-terminal.
+
+Emulates the parts of the STM32/DVI interface that bridge.py and
+read_static_values_modbustk.py rely on:
+  - FC01 coils 1..14 (bit 0 = "Soft starter Compressor", ...)
+  - FC04 input registers: sensors 0x01-0x0E and EM23 power/energy 0x24-0x26,
+    both single-register and block reads
+  - FC06 "echo" reads: writing 0 to a read address (< 0x100) returns the
+    stored value; writing to 0x1xx stores the value at the matching read
+    address. FABNR/SW/INDA/SEDA (151-155) answer with the long replies that
+    read_static_values_modbustk.py expects.
+  - FC03 block reads of the settings bank, only with --fc03
+
+With --tcp PORT the same device also answers Modbus TCP (MBAP) requests.
+
+Usage:
+  python modbus_simulator.py --link /tmp/dvi-sim
+  DVI_SERIAL_PORT=/tmp/dvi-sim python bridge.py
+  python modbus_simulator.py --tcp 5020
+  DVI_TRANSPORT=tcp:127.0.0.1:5020 python bridge.py
+"""
+
+import argparse
+import os
+import random
+import select
+import socket
+import struct
+import sys
+import time
+import tty
+
+from transport import crc16
+
+SLAVE_ADDR = 0x10
+
+# Modbus exception codes
+ILLEGAL_FUNCTION = 0x01
+ILLEGAL_DATA_ADDRESS = 0x02
+
+
+class HeatPumpModel:
+    """In-memory register state with a crude compressor/defrost cycle."""
+
+    def __init__(self, rng: random.Random):
+        self.rng = rng
+        self.started = time.monotonic()
+        # FC06 settings bank, keyed by read address
+        self.settings = {
+            0x01: 1,     # cv_mode
+            0x02: 6,     # cv_curve
+            0x03: 32,    # cv_setpoint
+            0x04: 0,     # cv_night
+            0x0A: 1,     # vv_mode
+            0x0B: 52,    # vv_setpoint
+            0x0C: 0,     # vv_schedule
+            0x0F: 1,     # aux_heating
+            0x1A: 2,     # central_heating_config
+            0x1B: 45,    # cv_max
+            0x1C: 20,    # cv_min
+            0x2F: 28, 0x30: 40,
+            0x31: 30, 0x32: 45,
+            0x33: 35, 0x34: 55,
+            0x8D: 0xFFFE,  # outdoor_cal = -2 (signed)
+            0xA1: 12034,   # comp_hours
+            0xA2: 2210,    # vv_hours
+            0xA3: 8800,    # heating_hours
+            0xD0: 367,     # curve_temp * 10
+        }
+        # Static identity: FABNR (6 bytes), SWBOT/SWTOP (5 bytes), INDA/SEDA (5 bytes)
+        self.static = {
+            153: bytes([0x00, 0x00, 0x00, 0x01, 0xE2, 0x40]),   # pumpid 123456
+            154: bytes([0x00, 0x00, ord("2"), ord("1"), ord("4")]),
+            155: bytes([0x00, 0x00, ord("3"), ord("0"), ord("7")]),
+            151: bytes([0x00, 0x00, 14, 3, 19]),
+            152: bytes([0x00, 0x00, 2, 9, 25]),
+        }
+        # Settings with a lower limit ignore out-of-range writes and echo the
+        # current value instead, which is what makes FC06 reads of 0x1xx safe.
+        self.minimum = {0x02: 1, 0x0B: 10, 0x1B: 20, 0x1C: 10,
+                        0x2F: 10, 0x30: 10, 0x31: 10, 0x32: 10, 0x33: 10, 0x34: 10}
+        self.energy = 1234567  # 0.1 kWh units, deliberately above 0xFFFF
+        self.last_tick = self.started
+
+    def tick(self) -> None:
+        now = time.monotonic()
+        dt = now - self.last_tick
+        self.last_tick = now
+        if self.compressor_on():
+            # ~2 kW while running: 2 kW * dt / 3600 s -> kWh, stored in 0.1 kWh
+            self.energy = (self.energy + int(round(dt * 2.0 / 360.0 * 10))) & 0xFFFFFFFF
+
+    def phase(self) -> float:
+        return (time.monotonic() - self.started) % 600.0
+
+    def compressor_on(self) -> bool:
+        return self.phase() < 360.0
+
+    def defrost(self) -> bool:
+        return 300.0 <= self.phase() < 330.0
+
+    def coils(self) -> int:
+        on = self.compressor_on()
+        bits = {
+            0: on,
+            1: 200.0 <= self.phase() < 260.0,  # 3-Way shunt VV
+            2: on,
+            4: on,
+            8: self.defrost(),
+            9: on and not self.defrost(),
+            12: True,
+        }
+        mask = 0
+        for bit, state in bits.items():
+            if state:
+                mask |= 1 << bit
+        return mask
+
+    def input_register(self, reg: int) -> int:
+        wobble = self.rng.randint(-3, 3)
+        on = self.compressor_on()
+        values = {
+            0x01: 345 + (40 if on else 0),   # CV Forward
+            0x02: 301 + (20 if on else 0),   # CV Return
+            0x03: 529,                        # Storage tank VV
+            0x05: 369,                        # Storage tank CV
+            0x06: -62 if on else 21,          # Evaporator
+            0x07: 46,                         # Outdoor
+            0x0B: 480 if on else 210,         # Compressor HP
+            0x0C: 12 if on else 150,          # Compressor LP
+        }
+        if reg in values:
+            return (values[reg] + wobble) & 0xFFFF
+        if 0x01 <= reg <= 0x0E:
+            return 0
+        if reg == 0x24:
+            return 20000 + self.rng.randint(-500, 500) if on else 150  # 0.0001 kW
+        if reg == 0x25:
+            return (self.energy >> 16) & 0xFFFF
+        if reg == 0x26:
+            return self.energy & 0xFFFF
+        raise KeyError(reg)
+
+    def fc06(self, reg: int, value: int) -> bytes:
+        """Return the 4 (or more) payload bytes answered after the function code."""
+        if reg in self.static and value == 0:
+            return self.static[reg]
+        if reg >= 0x100:
+            target = reg - 0x100
+            if value < self.minimum.get(target, 0):
+                return struct.pack(">HH", reg, self.settings.get(target, 0))
+            self.settings[target] = value
+            return struct.pack(">HH", reg, value)
+        if value == 0:
+            return struct.pack(">HH", reg, self.settings.get(reg, 0))
+        self.settings[reg] = value
+        return struct.pack(">HH", reg, value)
+
+
+class Simulator:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.model = HeatPumpModel(self.rng)
+        self.master_fd, slave_fd = os.openpty()
+        tty.setraw(slave_fd)
+        tty.setraw(self.master_fd)
+        self.slave_name = os.ttyname(slave_fd)
+        # Keep the slave end open so the pty survives bridge reconnects
+        self.slave_fd = slave_fd
+        self.buffer = b""
+        self.listener = None
+        self.tcp_clients = {}  # socket -> receive buffer
+        if args.tcp:
+            self.listener = socket.create_server(("127.0.0.1", args.tcp))
+        self.stats = {"requests": 0, "dropped": 0, "crc_errors": 0, "exceptions": 0}
+
+    # --- framing ---------------------------------------------------------
+    def _char_time(self) -> float:
+        return 11.0 / self.args.baud if self.args.baud else 0.0
+
+    def _exception(self, func: int, code: int) -> bytes:
+        self.stats["exceptions"] += 1
+        return bytes([SLAVE_ADDR, func | 0x80, code])
+
+    def handle(self, frame: bytes) -> bytes:
+        func = frame[1]
+        self.model.tick()
+        if func == 0x01:
+            start, count = struct.unpack(">HH", frame[2:6])
+            mask = self.model.coils() >> (start - 1) if start else self.model.coils()
+            nbytes = (count + 7) // 8
+            mask &= (1 << count) - 1
+            return bytes([SLAVE_ADDR, func, nbytes]) + mask.to_bytes(nbytes, "little")
+        if func == 0x04:
+            start, count = struct.unpack(">HH", frame[2:6])
+            if count > 1 and not self.args.block_fc04:
+                return self._exception(func, ILLEGAL_FUNCTION)
+            try:
+                values = [self.model.input_register(start + i) for i in range(count)]
+            except KeyError:
+                return self._exception(func, ILLEGAL_DATA_ADDRESS)
+            return bytes([SLAVE_ADDR, func, 2 * count]) + struct.pack(f">{count}H", *values)
+        if func == 0x03:
+            if not self.args.fc03:
+                return self._exception(func, ILLEGAL_FUNCTION)
+            start, count = struct.unpack(">HH", frame[2:6])
+            values = [self.model.settings.get(start + i, 0) for i in range(count)]
+            return bytes([SLAVE_ADDR, func, 2 * count]) + struct.pack(f">{count}H", *values)
+        if func == 0x06:
+            reg, value = struct.unpack(">HH", frame[2:6])
+            return bytes([SLAVE_ADDR, func]) + self.model.fc06(reg, value)
+        return self._exception(func, ILLEGAL_FUNCTION)
+
+    def _extract_frames(self):
+        # All requests used by the bridge are fixed 8-byte frames.
+        while len(self.buffer) >= 8:
+            frame = self.buffer[:8]
+            if frame[0] != SLAVE_ADDR or crc16(frame[:6]) != frame[6:8]:
+                self.buffer = self.buffer[1:]  # resync
+                continue
+            self.buffer = self.buffer[8:]
+            yield frame
+
+    def _hits_dead_register(self, frame: bytes) -> bool:
+        func = frame[1]
+        start, count = struct.unpack(">HH", frame[2:6])
+        if func == 0x06:
+            count = 1
+        elif func not in (0x03, 0x04):
+            return False
+        return any(start <= reg < start + count for reg in self.args.dead)
+
+    def respond(self, frame: bytes):
+        """RTU reply to an RTU request frame, None when the request is dropped."""
+        self.stats["requests"] += 1
+        if self._hits_dead_register(frame) or self.rng.random() < self.args.drop_rate:
+            self.stats["dropped"] += 1
+            return None
+        body = self.handle(frame)
+        response = body + crc16(body)
+        if self.rng.random() < self.args.crc_error_rate:
+            self.stats["crc_errors"] += 1
+            response = response[:-1] + bytes([response[-1] ^ 0xFF])
+        delay = self.args.latency / 1000.0 + len(response) * self._char_time()
+        if delay > 0:
+            time.sleep(delay)
+        return response
+
+    def _serve_tcp(self, sock) -> None:
+        try:
+            chunk = sock.recv(256)
+        except OSError:
+            chunk = b""
+        if not chunk:
+            self.tcp_clients.pop(sock, None)
+            sock.close()
+            return
+        buffer = self.tcp_clients[sock] + chunk
+        # MBAP: transaction id, protocol id, length (unit id + PDU)
+        while len(buffer) >= 6 and len(buffer) >= 6 + struct.unpack(">H", buffer[4:6])[0]:
+            tid, _, length = struct.unpack(">HHH", buffer[:6])
+            adu, buffer = buffer[6:6 + length], buffer[6 + length:]
+            if len(adu) != 6:
+                continue  # only the fixed 8-byte RTU requests are supported
+            response = self.respond(adu + crc16(adu))
+            if response is None:
+                continue
+            if crc16(response[:-2]) != response[-2:]:
+                continue  # a CRC error on the serial side is a lost reply over TCP
+            body = response[:-2]
+            sock.sendall(struct.pack(">HHH", tid, 0, len(body)) + body)
+        self.tcp_clients[sock] = buffer
+
+    def serve_forever(self) -> None:
+        last_report = time.monotonic()
+        while True:
+            sockets = list(self.tcp_clients) + ([self.listener] if self.listener else [])
+            ready, _, _ = select.select([self.master_fd] + sockets, [], [], 1.0)
+            for sock in ready:
+                if sock is self.listener:
+                    client, _ = self.listener.accept()
+                    self.tcp_clients[client] = b""
+                elif sock is not self.master_fd:
+                    self._serve_tcp(sock)
+            if self.master_fd in ready:
+                try:
+                    chunk = os.read(self.master_fd, 256)
+                except OSError:
+                    time.sleep(0.1)
+                    continue
+                self.buffer += chunk
+                # Request bytes take time on a real line as well
+                if self.args.baud:
+                    time.sleep(len(chunk) * self._char_time())
+                for frame in list(self._extract_frames()):
+                    response = self.respond(frame)
+                    if response is not None:
+                        os.write(self.master_fd, response)
+            if self.args.stats_interval and time.monotonic() - last_report >= self.args.stats_interval:
+                print(f"ℹ️ Simulator stats: {self.stats}", flush=True)
+                last_report = time.monotonic()
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="DVI LV Modbus RTU simulator on a pty")
+    parser.add_argument("--link", help="create a symlink to the pty at this path")
+    parser.add_argument("--latency", type=float, default=20.0, help="device turnaround in ms (default 20)")
+    parser.add_argument("--baud", type=int, default=9600, help="pace frames at this baud rate, 0 disables (default 9600)")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="probability of not answering a request")
+    parser.add_argument("--crc-error-rate", type=float, default=0.0, help="probability of corrupting a reply CRC")
+    parser.add_argument("--no-block-fc04", dest="block_fc04", action="store_false",
+                        help="reject multi-register FC04 reads like an old STM32 bridge")
+    parser.add_argument("--dead", type=lambda v: int(v, 0), action="append", default=[],
+                        help="never answer FC03/FC04/FC06 requests touching this register (repeatable, e.g. 0x05)")
+    parser.add_argument("--fc03", action="store_true", help="accept FC03 block reads of the settings bank")
+    parser.add_argument("--tcp", type=int, default=0, metavar="PORT",
+                        help="also answer Modbus TCP on 127.0.0.1:PORT")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--stats-interval", type=float, default=0.0, help="print request stats every N seconds")
+    args = parser.parse_args(argv)
+
+    sim = Simulator(args)
+    if args.link:
+        try:
+            os.unlink(args.link)
+        except FileNotFoundError:
+            pass
+        os.symlink(sim.slave_name, args.link)
+    print(f"✅ DVI simulator listening on {args.link or sim.slave_name} ({sim.slave_name})", flush=True)
+    if args.tcp:
+        print(f"✅ Modbus TCP on 127.0.0.1:{args.tcp}", flush=True)
+    try:
+        sim.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.link:
+            try:
+                os.unlink(args.link)
+            except OSError:
+                pass
+        print(f"ℹ️ Simulator stats: {sim.stats}", flush=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
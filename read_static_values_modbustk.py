@@ -1,12 +1,14 @@
 # -*- coding: utf-8 -*-
 """
 Læser FABNR/pumpid, SW-versioner (bot/top) og datoer (install/service)
-direkte fra DVI'en via modbus_tk og skriver resultaterne til:
+direkte fra DVI'en via transport.py og skriver resultaterne til:
   - ./config.cfg  (JSON med feltet "pumpid")
   - ./fabnr.cfg   (ren tekst med pumpid)
   - ./.env        (linjer FABNR=<pumpid>, SWBOT=<x.yz>, SWTOP=<x.yz>,
                    SERVICE_DD, SERVICE_MM, SERVICE_YY)
 Kør dette script på en Pi, der er direkte forbundet til DVI'en (uden STM32-bridge).
+bridge.py læser de samme registre selv over sin åbne transport og importerer
+konverteringerne herfra.
 """
 
 import json
@@ -14,21 +16,24 @@ import os
 import sys
 import time
 
-import serial
-from modbus_tk import modbus_rtu
+from transport import open_transport, spec_from_env
 
 # ---- Konfiguration ---------------------------------------------------------
 
-# TTY til DVI'en - juster hvis nødvendigt
-MODBUS_PORT = "/dev/ttyACM0"  # samme som ModbusPort i settings.py
+# TTY til DVI'en: MODBUS_PORT, ellers samme valg som bridge.py (DVI_TRANSPORT /
+# DVI_SERIAL_PORT / auto-detekteret STM32 Virtual COM Port), se transport.py
+MODBUS_PORT = os.getenv("MODBUS_PORT")
 SLAVE_ADDR = 16
-FUNCTION_CODE = 6
 FABNR_ADDR = 153  # register 153
 SWBOT_ADDR = 154
 SWTOP_ADDR = 155
 INDA_ADDR = 151  # installation date (INDA)
 SEDA_ADDR = 152  # service date (SEDA)
-QUANTITY = 1
+
+# Svar-timeout i s. Transporten holder selv RTU-minimum (3.5 tegn) mellem frames;
+# først prøves en kort timeout, svarer DVI'en ikke, prøves igen med den konservative.
+FAST_TIMEOUT = 0.5
+LEGACY_TIMEOUT = 2.0
 
 # Filer placeres i samme dir som dette script
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -39,17 +44,9 @@ ENV_PATH = os.path.join(BASE_DIR, ".env")
 # ---------------------------------------------------------------------------
 
 
-def open_master():
-    ser = serial.Serial(
-        port=MODBUS_PORT,
-        baudrate=9600,
-        bytesize=8,
-        parity="N",
-        stopbits=1,
-        xonxoff=0,
-    )
-    master = modbus_rtu.RtuMaster(ser, interchar_multiplier=20, interframe_multiplier=40)
-    master.set_timeout(2.0)
+def open_master(timeout=LEGACY_TIMEOUT):
+    master = open_transport(f"serial:{MODBUS_PORT}" if MODBUS_PORT else spec_from_env(), SLAVE_ADDR)
+    master.timeout = timeout
     return master
 
 
@@ -58,15 +55,7 @@ def read_fabnr_raw(master):
     Genskaber den gamle modbusopen(16, 6, 153, 1) med data_format="BBBBBB".
     Returnerer en sekvens med mindst 6 elementer, hvor index 3,4,5 er FABNR-bytes.
     """
-    out = master.execute(
-        SLAVE_ADDR,
-        FUNCTION_CODE,
-        FABNR_ADDR,
-        QUANTITY,
-        data_format="BBBBBB",
-        expected_length=10,
-    )
-    return out
+    return tuple(master.read_static(FABNR_ADDR, 6))
 
 
 def convert_fabnr_to_pumpid(fabnr_seq):
@@ -120,15 +109,7 @@ def read_sw_version_raw(master, addr):
       SWBOT = modbusopen(16, 6, 154, 1)  # data_format="BBBBB"
       SWTOP = modbusopen(16, 6, 155, 1)
     """
-    out = master.execute(
-        SLAVE_ADDR,
-        FUNCTION_CODE,
-        addr,
-        QUANTITY,
-        data_format="BBBBB",
-        expected_length=10,
-    )
-    return out
+    return tuple(master.read_static(addr, 5))
 
 
 def convert_sw_to_float(sw_seq):
@@ -145,7 +126,12 @@ def convert_sw_to_float(sw_seq):
     return float(s), s  # både float og strengrepræsentation
 
 
-def _update_env_key(key: str, value: str, *, force: bool = False):
+def update_env(values: dict, *, keep_existing=()) -> bool:
+    """
+    Merge values ({key: str}) into .env with one read and at most one write.
+    Keys in keep_existing are only added when missing, never overwritten.
+    Returns True if the file changed.
+    """
     env_lines = []
     if os.path.isfile(ENV_PATH):
         try:
@@ -154,28 +140,33 @@ def _update_env_key(key: str, value: str, *, force: bool = False):
         except Exception:
             env_lines = []
 
-    key_prefix = f"{key}="
-    found_idx = None
+    index = {}
     for idx, line in enumerate(env_lines):
-        if line.startswith(key_prefix):
-            found_idx = idx
-            break
-
-    if found_idx is not None and not force:
-        return False
-
-    new_line = f"{key}={value}\n"
-    if found_idx is not None and env_lines[found_idx] == new_line:
+        key = line.split("=", 1)[0]
+        if "=" in line and key not in index:
+            index[key] = idx
+
+    changed = []
+    for key, value in values.items():
+        new_line = f"{key}={value}\n"
+        idx = index.get(key)
+        if idx is None:
+            if env_lines and not env_lines[-1].endswith("\n"):
+                env_lines[-1] += "\n"
+            index[key] = len(env_lines)
+            env_lines.append(new_line)
+        elif key in keep_existing or env_lines[idx] == new_line:
+            continue
+        else:
+            env_lines[idx] = new_line
+        changed.append(f"{key}={value}")
+
+    if not changed:
         return False
-    if found_idx is None:
-        env_lines.append(new_line)
-    else:
-        env_lines[found_idx] = new_line
-
     try:
         with open(ENV_PATH, "w", encoding="utf-8") as f:
             f.writelines(env_lines)
-        print(f"💾 Updated {ENV_PATH} with {key}={value}")
+        print(f"💾 Updated {ENV_PATH} with {', '.join(changed)}")
         return True
     except Exception as e:
         print(f"⚠️ Could not write {ENV_PATH}: {e}")
@@ -189,15 +180,7 @@ def read_date_raw(master, addr):
       SEDA = modbusopen(16, 6, 152, 1)
     Layout: [slave, func, DD, MM, YY, ...]
     """
-    out = master.execute(
-        SLAVE_ADDR,
-        FUNCTION_CODE,
-        addr,
-        QUANTITY,
-        data_format="BBBBB",
-        expected_length=10,
-    )
-    return out
+    return tuple(master.read_static(addr, 5))
 
 
 def convert_date_to_dict(date_seq):
@@ -220,6 +203,7 @@ def persist_static_values(
     install_date: dict | None = None,
     service_date: dict | None = None,
 ):
+    """Write fabnr.cfg/config.cfg (first time only) and merge the values into .env in one write."""
     # Skriv fabnr.cfg som ren tekst (kun hvis FABNR ikke allerede findes i .env)
     env_fabnr = None
     if os.path.isfile(ENV_PATH):
@@ -252,43 +236,48 @@ def persist_static_values(
             json.dump(cfg, f)
         print(f"💾 Stored pumpid in {CONFIG_PATH}: {pumpid}")
 
-        # Kun hvis FABNR ikke fandtes i .env, sæt FABNR=<pumpid>
-        _update_env_key("FABNR", str(pumpid))
     else:
         print(f"ℹ️ FABNR already present in .env ({env_fabnr}), not overwriting.")
 
-    # SWBOT/SWTOP opdateres altid i .env (de kan ændres ved firmwareopdatering)
+    # Kun hvis FABNR ikke fandtes i .env, sæt FABNR=<pumpid>; installationsdatoen
+    # ændrer sig heller ikke. SWBOT/SWTOP opdateres altid (firmwareopdatering),
+    # og service-datoen ved hvert service.
+    env = {"FABNR": str(pumpid)}
+    keep_existing = {"FABNR"}
     if swbot_str is not None:
-        _update_env_key("SWBOT", swbot_str, force=True)
+        env["SWBOT"] = swbot_str
     if swtop_str is not None:
-        _update_env_key("SWTOP", swtop_str, force=True)
-
-    # Installationsdato: INSTALL_DD / INSTALL_MM / INSTALL_YY
+        env["SWTOP"] = swtop_str
     if install_date is not None:
-        _update_env_key("INSTALL_DD", str(install_date["DD"]))
-        _update_env_key("INSTALL_MM", str(install_date["MM"]))
-        _update_env_key("INSTALL_YY", str(install_date["YY"]))
-
-    # Service-dato: SERVICE_DD / SERVICE_MM / SERVICE_YY
+        env.update(INSTALL_DD=str(install_date["DD"]), INSTALL_MM=str(install_date["MM"]),
+                   INSTALL_YY=str(install_date["YY"]))
+        keep_existing |= {"INSTALL_DD", "INSTALL_MM", "INSTALL_YY"}
     if service_date is not None:
-        _update_env_key("SERVICE_DD", str(service_date["DD"]), force=True)
-        _update_env_key("SERVICE_MM", str(service_date["MM"]), force=True)
-        _update_env_key("SERVICE_YY", str(service_date["YY"]), force=True)
+        env.update(SERVICE_DD=str(service_date["DD"]), SERVICE_MM=str(service_date["MM"]),
+                   SERVICE_YY=str(service_date["YY"]))
+    update_env(env, keep_existing=keep_existing)
 
 
 def main():
-    print(f"Connecting to Modbus slave {SLAVE_ADDR} on {MODBUS_PORT} ...")
+    print(f"Connecting to Modbus slave {SLAVE_ADDR} ...")
     try:
-        master = open_master()
+        master = open_master(FAST_TIMEOUT)
     except Exception as e:
-        print(f"❌ Could not open Modbus master on {MODBUS_PORT}: {e}")
+        print(f"❌ Could not open Modbus transport: {e}")
         sys.exit(1)
+    print(f"✅ Using {master}")
 
     try:
         time.sleep(0.5)
 
-        # FABNR
-        fabnr_raw = read_fabnr_raw(master)
+        # FABNR (også test af om DVI'en svarer inden for den korte timeout)
+        try:
+            fabnr_raw = read_fabnr_raw(master)
+        except Exception as e:
+            print(f"⚠️ FABNR read with fast timeout failed ({e}), retrying with conservative timeout")
+            master.timeout = LEGACY_TIMEOUT
+            time.sleep(0.5)
+            fabnr_raw = read_fabnr_raw(master)
         print(f"✅ Raw FABNR response: {fabnr_raw!r}")
         pumpid = convert_fabnr_to_pumpid(fabnr_raw)
         print(f"🆔 Computed pumpid from FABNR: {pumpid}")
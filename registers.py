@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""
+Declarative register map for the DVI LV heatpump.
+
+Every value the bridge polls, publishes or writes is described once in
+REGISTERS. bridge.py builds the poll plan (block reads), the decoders, the
+MQTT command handling and the Home Assistant discovery from this table.
+"""
+
+from dataclasses import dataclass, field
+from typing import Optional
+
+# Function codes as used by the STM32 bridge
+FC_COILS = 1
+FC_INPUT = 4
+FC_ECHO = 6  # FC06 write of 0 to a read address answers with the current value
+
+# FC01 request covering all coils (start, count)
+COIL_BLOCK = (0x0001, 0x000E)
+
+# Bus priorities, lower runs first: MQTT commands, then the poll classes
+PRIORITY_COMMAND = 0
+PRIORITY_FAST = 1
+PRIORITY_NORMAL = 2
+PRIORITY_SLOW = 3
+
+# Poll class -> (default interval in seconds, priority)
+POLL_CLASSES = {
+    "coils": (13, PRIORITY_FAST),
+    "fc04": (10, PRIORITY_FAST),
+    "em23": (17, PRIORITY_FAST),
+    "fc06_live": (60, PRIORITY_NORMAL),        # values the controller computes
+    "fc06_settings": (300, PRIORITY_SLOW),     # only change when written
+    "fc06_counters": (600, PRIORITY_SLOW),     # operating hours
+}
+
+# Adaptive polling: while any of these coils is on the heatpump is "active"
+# and the adaptive poll classes switch to their active interval; when all
+# are off they back off to the idle interval.
+ACTIVE_COILS = (
+    "Soft starter Compressor",
+    "4-way valve defrost",
+    "3-Way shunt VV open/close",
+)
+
+# Poll class -> (active interval, idle interval) in seconds
+ADAPTIVE_INTERVALS = {
+    "fc04": (6, 30),
+    "em23": (6, 60),
+}
+
+# Heat curve points at +12/-12 °C live at different addresses depending on
+# central_heating_config (0x1A): config -> {"12": (read, write), "-12": (read, write)}
+CURVE_REGISTERS = {
+    0: {"12": (0x2F, 0x12F), "-12": (0x30, 0x130)},
+    1: {"12": (0x31, 0x131), "-12": (0x32, 0x132)},
+    2: {"12": (0x33, 0x133), "-12": (0x34, 0x134)},
+}
+
+
+@dataclass(frozen=True)
+class Register:
+    key: str                    # key in the dvi/measurement payload
+    address: Optional[int]      # read address, coil bit for FC01, None for curve points
+    function: int               # FC_COILS, FC_INPUT or FC_ECHO
+    poll: str                   # poll class, see POLL_CLASSES
+    signed: bool = False
+    words: int = 1              # 2 = unsigned 32-bit, MSW first
+    scale: float = 1
+    decimals: Optional[int] = None
+    omit: bool = False          # read as part of a block but never published
+    monotonic: bool = False     # reject readings that go backwards (total_increasing)
+    curve: Optional[str] = None  # "12"/"-12": address resolved via CURVE_REGISTERS
+    interval: Optional[float] = None  # overrides the poll class interval
+    priority: Optional[int] = None    # overrides the poll class priority
+
+    # Home Assistant discovery (component None = no entity)
+    component: Optional[str] = None
+    name: Optional[str] = None
+    unique_id: Optional[str] = None
+    unit: Optional[str] = None
+    device_class: Optional[str] = None
+    state_class: Optional[str] = None
+    entity_category: Optional[str] = None
+    value_template: Optional[str] = None
+    state_key: Optional[str] = None  # payload key the entity state is read from, defaults to key
+
+    # MQTT commands
+    command_topic: Optional[str] = None
+    write_address: Optional[int] = None
+    options: Optional[dict] = None   # raw value -> select option
+    command_aliases: dict = field(default_factory=dict)  # extra accepted payloads -> raw value
+    min_val: float = 0
+    max_val: float = 100
+    step: float = 1
+    affects: tuple = ()  # keys to read back as well after a write
+
+    @property
+    def poll_interval(self) -> float:
+        return self.interval if self.interval is not None else POLL_CLASSES[self.poll][0]
+
+    @property
+    def poll_priority(self) -> int:
+        return self.priority if self.priority is not None else POLL_CLASSES[self.poll][1]
+
+    @property
+    def section(self) -> str:
+        """Top-level key in the dvi/measurement payload."""
+        if self.function == FC_COILS:
+            return "coils"
+        if self.function == FC_INPUT:
+            return "input_registers"
+        return "write_registers"
+
+    @property
+    def addresses(self) -> range:
+        return range(self.address, self.address + self.words)
+
+    def decode(self, raw: int):
+        """Turn the raw unsigned register value into the published value."""
+        if self.signed and raw & (0x8000 << (16 * (self.words - 1))):
+            raw -= 1 << (16 * self.words)
+        if self.scale != 1:
+            return round(raw * self.scale, self.decimals)
+        return raw
+
+    def encode(self, value) -> int:
+        """Turn a command value into the raw register value."""
+        if self.scale != 1:
+            value = round(float(value) / self.scale)
+        return int(value) & 0xFFFF
+
+    def command_value(self, payload: str) -> Optional[int]:
+        """Parse an MQTT command payload, None if it is not a valid option."""
+        if self.options is not None:
+            for raw, option in self.options.items():
+                if option == payload:
+                    return raw
+            return self.command_aliases.get(payload)
+        return self.encode(int(payload))
+
+
+def _coil(bit: int, label: str) -> Register:
+    return Register(
+        key=label, address=bit, function=FC_COILS, poll="coils",
+        component="binary_sensor", unique_id=f"dvi_coil_{bit}", entity_category="diagnostic",
+    )
+
+
+def _sensor(reg: int, label: Optional[str] = None) -> Register:
+    key = f"sensor_{reg}"
+    if label is None:
+        return Register(key=key, address=reg, function=FC_INPUT, poll="fc04",
+                        signed=True, scale=0.1, decimals=1, omit=True)
+    return Register(
+        key=label, address=reg, function=FC_INPUT, poll="fc04",
+        signed=True, scale=0.1, decimals=1,
+        component="sensor", unique_id=f"dvi_fc04_{key}",
+        unit="°C", device_class="temperature", state_class="measurement",
+    )
+
+
+def _setting(reg: int, key: str, **kwargs) -> Register:
+    kwargs.setdefault("unique_id", f"dvi_fc06_{key}")
+    kwargs.setdefault("poll", "fc06_settings")
+    return Register(key=key, address=reg, function=FC_ECHO, **kwargs)
+
+
+def _select(reg: int, key: str, topic: str, options: dict, **kwargs) -> Register:
+    return _setting(reg, key, component="select", command_topic=topic,
+                    write_address=0x100 + reg, options=options, **kwargs)
+
+
+def _number(reg: int, key: str, topic: str, min_val, max_val, **kwargs) -> Register:
+    return _setting(reg, key, component="number", command_topic=topic,
+                    write_address=0x100 + reg, min_val=min_val, max_val=max_val, **kwargs)
+
+
+def _temperature(reg: int, key: str, **kwargs) -> Register:
+    return _setting(reg, key, component="sensor", unit="°C",
+                    device_class="temperature", state_class="measurement", **kwargs)
+
+
+def _hours(reg: int, key: str) -> Register:
+    return _setting(reg, key, poll="fc06_counters", component="sensor", unit="h",
+                    device_class="duration", state_class="total_increasing")
+
+
+def _curve_point(which: str) -> Register:
+    key = f"curve_set_{which}"
+    return Register(
+        key=key, address=None, function=FC_ECHO, poll="fc06_settings", curve=which,
+        component="number", unique_id=f"dvi_fc06_{key}", state_key=f"{key}_read",
+        command_topic=f"dvi/command/curveset{which}",
+        min_val=10, max_val=80, unit="°C", entity_category="config",
+    )
+
+
+REGISTERS = [
+    # Coils (6, 7 and 13 omitted)
+    _coil(0, "Soft starter Compressor"),
+    _coil(1, "3-Way shunt VV open/close"),
+    _coil(2, "Start/stop expansion valve"),
+    _coil(3, "Heating element"),
+    _coil(4, "Circ. pump warm side"),
+    _coil(5, "El-tracing CV/drain"),
+    _coil(8, "4-way valve defrost"),
+    _coil(9, "Liquid injection solenoid valve"),
+    _coil(10, "3-way shunt CV open"),
+    _coil(11, "3-way shunt CV close"),
+    _coil(12, "Circ. pump CV"),
+    _coil(14, "Sum alarm failure"),
+
+    # FC04 sensor bank 0x01-0x0E (unlabelled sensors are not published)
+    _sensor(0x01, "CV Forward"),
+    _sensor(0x02, "CV Return"),
+    _sensor(0x03, "Storage tank VV"),
+    _sensor(0x04),
+    _sensor(0x05, "Storage tank CV"),
+    _sensor(0x06, "Evaporator"),
+    _sensor(0x07, "Outdoor"),
+    _sensor(0x08),
+    _sensor(0x09),
+    _sensor(0x0A),
+    _sensor(0x0B, "Compressor HP"),
+    _sensor(0x0C, "Compressor LP"),
+    _sensor(0x0D),
+    _sensor(0x0E),
+
+    # EM23 energy meter
+    Register(
+        key="em23_power", address=0x24, function=FC_INPUT, poll="em23",
+        scale=0.0001, decimals=4,
+        component="sensor", unique_id="dvi_fc04_power",
+        unit="kW", device_class="power", state_class="measurement",
+        value_template="{{ value_json.input_registers['em23_power'] | float | round(3) }}",
+    ),
+    Register(
+        key="em23_energy", address=0x25, function=FC_INPUT, poll="em23",
+        words=2, scale=0.1, decimals=1, monotonic=True,
+        component="sensor", unique_id="dvi_fc04_energy",
+        unit="kWh", device_class="energy", state_class="total_increasing",
+    ),
+
+    # FC06 settings bank, read via the FC06 echo
+    _select(0x01, "cv_mode", "dvi/command/cvstate", {0: "Off", 1: "On"}),
+    _number(0x02, "cv_curve", "dvi/command/cvcurve", 1, 20),
+    _temperature(0x03, "cv_setpoint", poll="fc06_live"),
+    _select(0x04, "cv_night", "dvi/command/cvnight",
+            {0: "Timer", 1: "Constant day", 2: "Constant night"}),
+    _select(0x0A, "vv_mode", "dvi/command/vvstate", {0: "Off", 1: "On"}),
+    _number(0x0B, "vv_setpoint", "dvi/command/vvsetpoint", 10, 60, unit="°C"),
+    _select(0x0C, "vv_schedule", "dvi/command/vvschedule",
+            {0: "Timer", 1: "Constant on", 2: "Constant off"}),
+    _select(0x0F, "aux_heating", "dvi/command/tvstate",
+            {0: "Off", 1: "Automatic", 2: "On"},
+            command_aliases={"Backup operation": 2}),
+    _hours(0xA1, "comp_hours"),
+    _hours(0xA2, "vv_hours"),
+    _hours(0xA3, "heating_hours"),
+    _temperature(0xD0, "curve_temp", poll="fc06_live", scale=0.1, decimals=1),
+    _select(0x1A, "central_heating_config", "dvi/command/centralheatingconfig",
+            {0: "Under floor heating w/o shunt",
+             1: "Under floor heating w. shunt",
+             2: "Radiator and mixed systems"},
+            entity_category="config", affects=("curve_set_-12", "curve_set_12")),
+    _number(0x1B, "cv_max", "dvi/command/cvmax", 20, 55, unit="°C", entity_category="config"),
+    _number(0x1C, "cv_min", "dvi/command/cvmin", 10, 45, unit="°C", entity_category="config"),
+    # Writable at 0x18D, but exposed read-only for now
+    _temperature(0x8D, "outdoor_cal", signed=True, scale=0.1, decimals=1),
+    _curve_point("-12"),
+    _curve_point("12"),
+]
+
+REGISTERS_BY_KEY = {reg.key: reg for reg in REGISTERS}
+COMMAND_REGISTERS = {reg.command_topic: reg for reg in REGISTERS if reg.command_topic}
+
+
+def block_ranges(registers, max_gap: int = 0, max_count: int = 125) -> list:
+    """
+    Group the addresses of *registers* into (start, count) spans for block
+    reads. Gaps of up to *max_gap* unused registers are read through.
+    """
+    addresses = sorted({a for reg in registers for a in reg.addresses})
+    spans = []
+    for addr in addresses:
+        if spans:
+            start, count = spans[-1]
+            if addr - (start + count) <= max_gap and addr - start < max_count:
+                spans[-1] = (start, addr - start + 1)
+                continue
+        spans.append((addr, 1))
+    return spans
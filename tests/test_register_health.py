@@ -0,0 +1,55 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from diagnostics import RegisterHealth  # noqa: E402
+
+SPAN_START, SPAN_COUNT, DEAD = 0x01, 12, 0x05
+
+
+def poll_span_with_dead_register(health: RegisterHealth) -> bool:
+    """
+    One FC04 cycle as bridge.read_input_range() runs it with 0x05 not answering:
+    the block read times out, the per-register fallback reads every address.
+    Returns whether the block read was attempted.
+    """
+    attempted = not health.skip(4, SPAN_START, SPAN_COUNT)
+    if attempted:
+        health.failed(4, SPAN_START, SPAN_COUNT)
+    for register in range(SPAN_START, SPAN_START + SPAN_COUNT):
+        if health.skip(4, register):
+            continue
+        if register == DEAD:
+            health.failed(4, register)
+        else:
+            health.succeeded(4, register)
+    return attempted
+
+
+def test_block_key_is_separate_from_its_first_register():
+    assert RegisterHealth.key(4, 0x01) == "fc04@0x01"
+    assert RegisterHealth.key(4, 0x01, 12) == "fc04@0x01+12"
+    assert RegisterHealth.key(4, 0x01, 1) == RegisterHealth.key(4, 0x01)
+
+
+def test_dead_register_inside_span_quarantines_the_span():
+    health = RegisterHealth()
+    health.succeeded(1, 0x00)  # the bus answered before the first cycle
+    for _ in range(RegisterHealth.QUARANTINE_AFTER):
+        assert poll_span_with_dead_register(health)
+
+    assert health.skip(4, SPAN_START, SPAN_COUNT)
+    assert not poll_span_with_dead_register(health)
+    registers = health.snapshot()["registers"]
+    assert registers[RegisterHealth.key(4, SPAN_START, SPAN_COUNT)]["state"] == "quarantined"
+    assert RegisterHealth.key(4, SPAN_START) not in registers  # the single read of 0x01 is healthy
+
+
+def test_block_success_lifts_the_span_quarantine():
+    health = RegisterHealth()
+    health.succeeded(1, 0x00)
+    for _ in range(RegisterHealth.QUARANTINE_AFTER):
+        poll_span_with_dead_register(health)
+    assert health.succeeded(4, SPAN_START, SPAN_COUNT) == "fc04@0x01+12"
+    assert not health.skip(4, SPAN_START, SPAN_COUNT)
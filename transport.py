@@ -0,0 +1,532 @@
+# -*- coding: utf-8 -*-
+"""
+Modbus RTU transport shared by bridge.py and read_static_values_modbustk.py.
+
+One Transport owns the connection to the DVI and speaks in plain RTU frames
+(bytes in, bytes out); the backend decides how the frames travel:
+  stm32            STM32 Virtual COM Port, auto-detected in /dev/serial/by-id (default)
+  serial:<path>    direct RS485 adapter or a pty (modbus_simulator.py), 9600 8N1
+  tcp:<host>:<port>  Modbus TCP stand-in (e.g. modbus_simulator.py --tcp)
+
+The helpers on top (read_bits, read_registers, echo_read, write_register,
+read_static) cover the FC01/FC04/FC06 operations the DVI answers.
+"""
+
+import glob
+import os
+import socket
+import struct
+import threading
+import time
+
+SLAVE_ADDR = 0x10
+BAUDRATE = 9600
+DEFAULT_TIMEOUT = 2.0
+STM32_GLOB = "/dev/serial/by-id/*STM32*"
+
+
+# diagnostics.classify_error() maps these onto its error kinds
+class TransportError(Exception):
+    pass
+
+
+class NoResponseError(TransportError):
+    pass
+
+
+class InvalidResponseError(TransportError):
+    pass
+
+
+class ChecksumError(InvalidResponseError):
+    pass
+
+
+class SlaveReportedException(TransportError):
+    # Modbus exception codes meaning the request itself is not supported
+    ILLEGAL_REQUEST = (1, 2, 3)  # illegal function, data address, data value
+
+    def __init__(self, message: str, code: int = 0) -> None:
+        super().__init__(message)
+        self.code = code
+
+    @property
+    def rejected(self) -> bool:
+        return self.code in self.ILLEGAL_REQUEST
+
+
+class DisconnectedError(TransportError, ConnectionError):
+    """The port is gone; raised without touching the bus until the next reconnect attempt."""
+
+
+def _crc_table() -> list:
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_CRC_TABLE = _crc_table()
+
+
+def crc16(data) -> bytes:
+    """Modbus RTU CRC of data (bytes or memoryview), little endian as sent on the wire."""
+    crc = 0xFFFF
+    for byte in data:
+        crc = (crc >> 8) ^ _CRC_TABLE[(crc ^ byte) & 0xFF]
+    return crc.to_bytes(2, "little")
+
+
+def frame(slave: int, functioncode: int, payload: bytes) -> bytes:
+    body = bytes((slave, functioncode)) + payload
+    return body + crc16(body)
+
+
+# --- Backends ----------------------------------------------------------------
+
+class SerialBackend:
+    """RS485 adapter, pty or the STM32 Virtual COM Port (9600 8N1)."""
+
+    def __init__(self, path: str, baudrate: int = BAUDRATE) -> None:
+        import serial  # pyserial, only needed for serial backends
+
+        try:
+            import termios  # tcflush() on a vanished tty raises termios.error, not an OSError
+            self._port_errors = (serial.SerialException, termios.error)
+        except ImportError:
+            self._port_errors = (serial.SerialException,)
+        self.path = path
+        # RTU needs 3.5 characters of silence between frames
+        self.silent_period = 3.5 * 11 / baudrate
+        self._port = serial.Serial(path, baudrate=baudrate, bytesize=8, parity="N",
+                                   stopbits=1, timeout=DEFAULT_TIMEOUT)
+        self._last_io = 0.0
+
+    @property
+    def timeout(self) -> float:
+        return self._port.timeout
+
+    @timeout.setter
+    def timeout(self, value: float) -> None:
+        self._port.timeout = value
+
+    def exchange(self, request: bytes, reply_length: int) -> bytes:
+        quiet = self._last_io + self.silent_period - time.monotonic()
+        if quiet > 0:
+            time.sleep(quiet)
+        try:
+            self._port.reset_input_buffer()
+            self._port.write(request)
+            # Address and function code first: an exception reply is only 5 bytes,
+            # so don't sit out the timeout waiting for a full-length answer
+            reply = self._port.read(2)
+            if len(reply) == 2:
+                reply += self._port.read(3 if reply[1] & 0x80 else reply_length - 2)
+        except self._port_errors as e:
+            raise ConnectionError(f"{self.path}: {e}") from e
+        self._last_io = time.monotonic()
+        return reply
+
+    def alive(self) -> bool:
+        # A USB reset removes the /dev/serial/by-id link before reads start failing
+        return os.path.exists(self.path)
+
+    def close(self) -> None:
+        self._port.close()
+
+    def __str__(self) -> str:
+        return self.path
+
+
+class TcpBackend:
+    """Modbus TCP: the RTU frame is re-wrapped in an MBAP header and back."""
+
+    def __init__(self, host: str, port: int) -> None:
+        self.host, self.port = host, port
+        self._timeout = DEFAULT_TIMEOUT
+        self._sock = None
+        self._open()
+        self._tid = 0
+
+    def _open(self) -> None:
+        self._sock = socket.create_connection((self.host, self.port), timeout=self._timeout)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _resync(self) -> None:
+        """
+        Drop the connection after a timeout or a partial frame: the rest of the
+        reply may still arrive and would shift the next MBAP header (the TCP
+        counterpart of reset_input_buffer() on the serial port).
+        """
+        self._sock.close()
+        try:
+            self._open()
+        except OSError as e:
+            raise ConnectionError(f"Modbus TCP peer {self} gone after a timeout: {e}") from e
+
+    @property
+    def timeout(self) -> float:
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, value: float) -> None:
+        self._timeout = value
+        self._sock.settimeout(value)
+
+    def _recv(self, count: int) -> bytes:
+        data = bytearray()
+        while len(data) < count:
+            try:
+                chunk = self._sock.recv(count - len(data))
+            except socket.timeout:
+                break
+            if not chunk:
+                raise ConnectionError(f"Modbus TCP peer {self} closed the connection")
+            data += chunk
+        return bytes(data)
+
+    def exchange(self, request: bytes, reply_length: int) -> bytes:
+        self._tid = (self._tid + 1) & 0xFFFF
+        adu = memoryview(request)[:-2]  # unit id + PDU, the CRC is not sent over TCP
+        self._sock.sendall(struct.pack(">HHH", self._tid, 0, len(adu)) + adu)
+        while True:
+            header = self._recv(6)
+            if len(header) < 6:
+                self._resync()
+                return b""
+            tid, _, length = struct.unpack(">HHH", header)
+            body = self._recv(length)
+            if len(body) < length:
+                self._resync()
+                return body
+            if tid == self._tid:
+                break  # else: a late answer to a request that already timed out
+        return body + crc16(body)
+
+    def alive(self) -> bool:
+        return True  # a dropped connection raises in _recv()
+
+    def close(self) -> None:
+        self._sock.close()
+
+    def __str__(self) -> str:
+        return f"tcp:{self.host}:{self.port}"
+
+
+def find_stm32_port() -> str:
+    devices = sorted(glob.glob(STM32_GLOB))
+    if not devices:
+        raise TransportError("STM32 Virtual COM Port not found! Check USB cable and that the heatpump interface is connected.")
+    return devices[0]
+
+
+def backend_from_spec(spec: str):
+    """'stm32', 'serial:/dev/ttyUSB0' or 'tcp:127.0.0.1:5020' -> backend."""
+    kind, _, target = spec.partition(":")
+    if kind == "stm32":
+        return SerialBackend(target or find_stm32_port())
+    if kind == "serial":
+        return SerialBackend(target)
+    if kind == "tcp":
+        host, _, port = target.rpartition(":")
+        return TcpBackend(host or "127.0.0.1", int(port))
+    raise ValueError(f"unknown transport {spec!r} (use stm32, serial:<path> or tcp:<host>:<port>)")
+
+
+def device_present(spec: str) -> bool:
+    """Whether the device node behind a serial spec exists; always False for tcp."""
+    kind, _, target = spec.partition(":")
+    if kind == "stm32":
+        return os.path.exists(target) if target else bool(glob.glob(STM32_GLOB))
+    if kind == "serial":
+        return os.path.exists(target)
+    return False
+
+
+def spec_from_env() -> str:
+    """DVI_TRANSPORT wins; DVI_SERIAL_PORT is shorthand for serial:<path>; default stm32."""
+    spec = os.getenv("DVI_TRANSPORT", "").strip()
+    if spec:
+        return spec
+    port = os.getenv("DVI_SERIAL_PORT", "").strip()
+    return f"serial:{port}" if port else "stm32"
+
+
+# --- Adaptive reply timeout ----------------------------------------------------
+
+class AdaptiveTimeout:
+    """
+    Learns the round-trip time per function code from successful reads and
+    waits p95 * 1.5 + 50 ms (clamped to MIN..the transport timeout) for a
+    reply. Writes are not learned and always get the full timeout: a settings
+    or EEPROM write can take longer than an echo read and must not be reported
+    as failed while the DVI applies it. The first transaction after a timeout
+    gets the full timeout again, so a slow but alive device is re-learned;
+    repeated timeouts fail fast.
+    """
+
+    SAMPLES = 50
+    MIN_SAMPLES = 10
+    MIN = 0.25
+
+    def __init__(self, enabled: bool = True) -> None:
+        self.enabled = enabled
+        self.maximum = DEFAULT_TIMEOUT
+        self._rtts: dict = {}  # functioncode -> recent round-trip times
+        self._timeouts: dict = {}  # functioncode -> learned timeout
+        self._consecutive_timeouts = 0
+
+    def timeout_for(self, functioncode: int) -> float:
+        if not self.enabled or self._consecutive_timeouts == 1:
+            return self.maximum
+        return min(self.maximum, self._timeouts.get(functioncode, self.maximum))
+
+    def succeeded(self, functioncode: int, seconds: float) -> None:
+        self._consecutive_timeouts = 0
+        rtts = self._rtts.setdefault(functioncode, [])
+        rtts.append(seconds)
+        del rtts[:-self.SAMPLES]
+        if len(rtts) >= self.MIN_SAMPLES:
+            ordered = sorted(rtts)
+            p95 = ordered[int(0.95 * (len(ordered) - 1))]
+            self._timeouts[functioncode] = round(max(self.MIN, p95 * 1.5 + 0.05), 3)
+
+    def timed_out(self) -> None:
+        self._consecutive_timeouts += 1
+
+    def snapshot(self) -> dict:
+        return {f"fc{fc:02d}": self.timeout_for(fc) for fc in sorted(self._rtts)}
+
+
+# --- Transport -----------------------------------------------------------------
+
+class Transport:
+    """
+    The single owner of the link to the DVI. exchange() sends one request
+    frame and returns the raw reply; transact() adds framing and checks.
+    Calls are serialised with a lock, bridge.py additionally queues them
+    on its bus thread.
+
+    When the port disappears (USB reset, brown-out) the backend is dropped
+    and reopened in place from the same spec, so a re-enumerated STM32 is
+    found again. Until then every call fails fast with DisconnectedError.
+    Reconnect attempts back off from RECONNECT_MIN to RECONNECT_MAX seconds,
+    but the device node reappearing in /dev makes one due right away.
+
+    timeout is the reply timeout for writes and the upper bound for reads;
+    with an AdaptiveTimeout in adaptive, reads wait for the learned one.
+    """
+
+    RECONNECT_MIN = 1.0
+    RECONNECT_MAX = 30.0
+
+    def __init__(self, spec: str, slave: int = SLAVE_ADDR, on_bytes=None) -> None:
+        self.spec = spec
+        self.backend = None
+        self.address = slave
+        self.on_bytes = on_bytes  # callback(sent, received) for byte counters
+        self.on_reconnect = None  # callback(seconds down), called after a reopen
+        self.adaptive = None  # optional AdaptiveTimeout for reads
+        self._timeout = DEFAULT_TIMEOUT
+        self._lock = threading.Lock()
+        self._lost_at = None  # monotonic time the port was lost
+        self._next_attempt = 0.0
+        self._backoff = self.RECONNECT_MIN
+        self._node_seen = False  # device node present at the last failed attempt
+        self.disconnects = 0
+        self.reconnects = 0
+        self.last_recovery = None  # seconds from loss to reopen
+        self.downtime = 0.0
+
+    def connect(self) -> None:
+        """Open the backend; raises if the port is not there (yet)."""
+        backend = backend_from_spec(self.spec)
+        backend.timeout = self._timeout
+        self.backend = backend
+
+    @property
+    def connected(self) -> bool:
+        return self.backend is not None
+
+    def waiting(self) -> bool:
+        """True while disconnected and the next reconnect attempt is not due yet."""
+        return self.backend is None and not self._attempt_due(time.monotonic())
+
+    def _attempt_due(self, now: float) -> bool:
+        if now >= self._next_attempt:
+            return True
+        present = device_present(self.spec)
+        if not present:
+            self._node_seen = False
+        return present and not self._node_seen
+
+    @property
+    def timeout(self) -> float:
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, value: float) -> None:
+        self._timeout = value  # applied on the next exchange, under the lock
+
+    def mark_lost(self, reason) -> None:
+        """Drop the backend (e.g. it was never there at startup) and start reconnecting."""
+        with self._lock:
+            self._lose(reason)
+
+    def _lose(self, reason) -> None:
+        if self.backend is not None:
+            try:
+                self.backend.close()
+            except Exception:
+                pass
+            self.backend = None
+        if self._lost_at is None:
+            self._lost_at = time.monotonic()
+            self.disconnects += 1
+            self._backoff = self.RECONNECT_MIN
+            self._next_attempt = self._lost_at + self._backoff
+            self._node_seen = device_present(self.spec)
+            print(f"🔌 Lost the heatpump interface ({reason}), reconnecting in the background")
+
+    def _reconnect(self) -> float:
+        """Reopen the backend when an attempt is due; returns the downtime, raises while still gone."""
+        now = time.monotonic()
+        if not self._attempt_due(now):
+            raise DisconnectedError(f"Heatpump interface {self.spec} disconnected")
+        try:
+            self.connect()
+        except Exception as e:
+            self._backoff = min(self._backoff * 2, self.RECONNECT_MAX)
+            self._next_attempt = now + self._backoff
+            self._node_seen = device_present(self.spec)
+            raise DisconnectedError(f"Heatpump interface {self.spec} still gone ({e}), "
+                                    f"next attempt in {self._backoff:.0f}s") from None
+        down = now - self._lost_at
+        self._lost_at = None
+        self.reconnects += 1
+        self.last_recovery = down
+        self.downtime += down
+        print(f"🔌 Reconnected to {self.backend} after {down:.1f}s")
+        return down
+
+    def reconnect(self) -> bool:
+        """Reopen a lost backend if an attempt is due; True while connected."""
+        with self._lock:
+            if self.backend is not None:
+                return True
+            try:
+                down = self._reconnect()
+            except DisconnectedError:
+                return False
+        if self.on_reconnect is not None:
+            self.on_reconnect(down)
+        return True
+
+    def exchange(self, request: bytes, reply_length: int, timeout: float = None) -> bytes:
+        recovered = None
+        timeout = timeout or self._timeout
+        with self._lock:
+            if self.backend is None:
+                recovered = self._reconnect()
+            try:
+                if self.backend.timeout != timeout:
+                    self.backend.timeout = timeout
+                reply = self.backend.exchange(request, reply_length)
+            except OSError as e:  # pyserial's SerialException is an OSError as well
+                self._lose(e)
+                raise DisconnectedError(str(e)) from e
+            if not reply and not self.backend.alive():
+                self._lose("device node removed")
+                raise DisconnectedError(f"Heatpump interface {self.spec} disconnected")
+        if self.on_bytes is not None:
+            self.on_bytes(len(request), len(reply))
+        if recovered is not None and self.on_reconnect is not None:
+            self.on_reconnect(recovered)
+        return reply
+
+    def snapshot(self) -> dict:
+        down = time.monotonic() - self._lost_at if self._lost_at is not None else 0.0
+        return {
+            "transport": self.spec,
+            "connected": self.connected,
+            "disconnects": self.disconnects,
+            "reconnects": self.reconnects,
+            "last_recovery_s": self.last_recovery and round(self.last_recovery, 1),
+            "downtime_s": round(self.downtime + down, 1),
+        }
+
+    def transact(self, functioncode: int, payload: bytes, reply_length: int, learn: bool = True) -> memoryview:
+        """
+        Send one request; returns the reply data after the function code (CRC stripped).
+        learn=False (writes) waits the full timeout and leaves the learned ones alone.
+        """
+        adaptive = self.adaptive if learn else None
+        timeout = None
+        if adaptive is not None:
+            adaptive.maximum = self._timeout
+            timeout = adaptive.timeout_for(functioncode)
+        started = time.perf_counter()
+        reply = self.exchange(frame(self.address, functioncode, payload), reply_length, timeout)
+        if not reply:
+            if self.adaptive is not None:
+                self.adaptive.timed_out()
+            raise NoResponseError(f"No answer from slave 0x{self.address:02X} (fc{functioncode:02d})")
+        view = memoryview(reply)
+        if len(reply) < 5:
+            raise InvalidResponseError(f"Short reply ({len(reply)} bytes): {reply.hex()}")
+        if crc16(view[:-2]) != reply[-2:]:
+            raise ChecksumError(f"CRC mismatch ({len(reply)} bytes): {reply.hex()}")
+        if reply[0] != self.address:
+            raise InvalidResponseError(f"Reply from slave 0x{reply[0]:02X}, expected 0x{self.address:02X}")
+        if reply[1] == functioncode | 0x80:
+            raise SlaveReportedException(f"Slave reported exception code {reply[2]} for fc{functioncode:02d}",
+                                         reply[2])
+        if reply[1] != functioncode or len(reply) != reply_length:
+            raise InvalidResponseError(f"Unexpected reply to fc{functioncode:02d}: {reply.hex()}")
+        if adaptive is not None:
+            adaptive.succeeded(functioncode, time.perf_counter() - started)
+        return view[2:-2]
+
+    def read_bits(self, start: int, count: int, functioncode: int = 1) -> list:
+        """Coil states, LSB of the first byte first, padded to whole bytes like the reply."""
+        nbytes = (count + 7) // 8
+        data = self.transact(functioncode, struct.pack(">HH", start, count), 5 + nbytes)
+        if data[0] != nbytes:
+            raise InvalidResponseError(f"fc{functioncode:02d} byte count {data[0]}, expected {nbytes}")
+        mask = int.from_bytes(data[1:], "little")
+        return [(mask >> i) & 1 for i in range(8 * nbytes)]
+
+    def read_registers(self, start: int, count: int, functioncode: int = 4) -> list:
+        data = self.transact(functioncode, struct.pack(">HH", start, count), 5 + 2 * count)
+        if data[0] != 2 * count:
+            raise InvalidResponseError(f"fc{functioncode:02d} byte count {data[0]}, expected {2 * count}")
+        return list(struct.unpack_from(f">{count}H", data, 1))
+
+    def write_register(self, register: int, value: int, learn: bool = False) -> int:
+        """FC06; returns the value the DVI echoes back."""
+        data = self.transact(6, struct.pack(">HH", register, value), 8, learn)
+        return struct.unpack_from(">H", data, 2)[0]
+
+    def echo_read(self, register: int) -> int:
+        """The DVI answers an FC06 write of 0 to a read address with the current value."""
+        return self.write_register(register, 0, learn=True)
+
+    def read_static(self, register: int, data_bytes: int) -> bytes:
+        """FC06 echo of FABNR/SW/INDA/SEDA, which answer with data_bytes instead of 4."""
+        return bytes(self.transact(6, struct.pack(">HH", register, 0), 4 + data_bytes, learn=False))
+
+    def close(self) -> None:
+        if self.backend is not None:
+            self.backend.close()
+
+    def __str__(self) -> str:
+        return str(self.backend) if self.backend is not None else self.spec
+
+
+def open_transport(spec: str = None, slave: int = SLAVE_ADDR, on_bytes=None) -> Transport:
+    transport = Transport(spec or spec_from_env(), slave, on_bytes)
+    transport.connect()
+    return transport